@@ -0,0 +1,103 @@
+import asyncio, platform, os, logging
+from main import run_main
+from headless import run_headless, get_firefox_path
+from browser_pool import BrowserPool, get_pool, set_pool
+from ratelimit import upstream_pacer, account_id, UpstreamBusy
+from cancellation import CancelToken, bounded_timeout
+from cookie_helpers import is_running_in_docker
+
+logger = logging.getLogger("gemini-api")
+
+def start_pool_from_env():
+    """Start and register the shared BrowserPool configured by env; returns None if disabled or unavailable."""
+    if os.getenv('BROWSER_POOL', 'true').lower() != 'true':
+        return None
+    try:
+        pool = BrowserPool(
+            firefox_path=get_firefox_path(),
+            # No display in a container: always headless there, as run_headless does per request
+            headless=os.getenv('HEADLESS', 'true').lower() != 'false' or is_running_in_docker(),
+            state_dir=os.getenv('STORAGE_STATE_DIR', './state'),
+            refresh_interval=float(os.getenv('STORAGE_STATE_REFRESH', '1800')),
+            max_contexts=int(os.getenv('BROWSER_POOL_CONTEXTS', '4')),
+            warm_contexts=int(os.getenv('BROWSER_WARM_CONTEXTS', '1')),
+        )
+        # Runs on its own loop thread so Playwright can spawn Firefox regardless of the host loop type
+        pool.start_background()
+        set_pool(pool)
+        return pool
+    except Exception as e:
+        logger.warning(f"Browser pool unavailable, falling back to per-request browsers: {e}")
+        return None
+
+# Backend runners shared by /api, /browser, /generate and the job workers
+async def run_http_backend(args: dict) -> dict:
+    # Queue for the upstream slot on the loop, so waiting requests do not each hold a thread
+    if args.get('at_token'):
+        try:
+            await upstream_pacer.acquire_async(account_id(), args.get('client') or 'default', cancel=args.get('cancel'))
+        except UpstreamBusy as e:
+            return {"status": "error", "errors": [str(e)], "upstream_busy": True}
+        args['paced'] = True
+    # run_main blocks on the upstream stream; keep it off the event loop
+    return await asyncio.to_thread(run_main, args)
+
+async def run_browser_backend(args: dict) -> dict:
+    args.update({
+        'cookies': os.getenv('GEMINI_COOKIES'),
+        'cookies_file': os.getenv('GEMINI_COOKIES_FILE'),
+        'public_url': os.getenv('PUBLIC_URL'),
+        'no_headless': os.getenv('HEADLESS','false').lower() == 'false'
+    })
+    
+    # Validate required environment variables for browser endpoint
+    if not args.get('cookies') and not args.get('cookies_file'):
+        logger.warning("No cookies configured for browser endpoint")
+    
+    # Browser traffic draws from the same upstream budget as the HTTP path for this cookie set
+    cancel = args.get('cancel')
+    try:
+        await upstream_pacer.acquire_async(account_id(args.get('cookies'), args.get('cookies_file')),
+                                           args.get('client') or 'default', cancel=cancel)
+    except UpstreamBusy as e:
+        return {"status": "error", "errors": [str(e)], "upstream_busy": True}
+    
+    pool = get_pool()
+    if pool is not None:
+        args['pool'] = pool
+        # Cancelling this await cancels the flow on the pool loop, which closes its context
+        return await asyncio.wait_for(run_headless(args), timeout=bounded_timeout(cancel, 300))  # 5 minute timeout
+    
+    # Run headless in a separate thread with proper event loop for Windows
+    def run_headless_sync():
+        try:
+            if platform.system() == 'Windows':
+                asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                task = loop.create_task(run_headless(args))
+                # A cancelled request cancels the flow in this thread's loop, closing the browser
+                if cancel: cancel.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel) if not loop.is_closed() else None)
+                return loop.run_until_complete(task)
+            finally:
+                loop.close()
+        except asyncio.CancelledError:
+            return {"status": "error", "errors": [f"Cancelled: {cancel.reason if cancel else 'cancelled'}"]}
+        except Exception as e:
+            logger.error(f"Error in headless execution: {e}", exc_info=True)
+            return {"status": "error", "errors": [str(e)]}
+    
+    # Own thread rather than a blocking future.result(), so the event loop stays free and
+    # the deadline / disconnect reaches the worker through the cancel token
+    if cancel is None:
+        cancel = args['cancel'] = CancelToken(300)  # 5 minute timeout
+    worker = asyncio.to_thread(run_headless_sync)
+    try:
+        return await asyncio.wait_for(worker, timeout=bounded_timeout(cancel, 300))
+    except asyncio.TimeoutError:
+        cancel.cancel("deadline exceeded")
+        raise
+    except asyncio.CancelledError:
+        cancel.cancel("cancelled")
+        raise
@@ -0,0 +1,333 @@
+import asyncio, os, json, time, hashlib, logging, threading, platform
+from collections import deque
+from pathlib import Path
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+from playwright.async_api import async_playwright
+
+logger = logging.getLogger("gemini-browser-pool")
+
+GEMINI_APP_URL = "https://gemini.google.com/app"
+SIGN_IN_SELECTOR = "a[href*='accounts.google.com/ServiceLogin']"
+
+# ---------------- HELPERS ---------------- #
+def account_key(cookies: List[Dict[str, Any]]) -> str:
+    """Stable short id for a cookie set, used to key storage_state snapshots."""
+    ident = sorted(f"{c.get('domain','')}|{c.get('name','')}={c.get('value','')}" for c in cookies)
+    return hashlib.sha1("\n".join(ident).encode()).hexdigest()[:16]
+
+# ---------------- POOL ---------------- #
+class BrowserPool:
+    """
+    One long-lived Firefox process shared by many lightweight contexts.
+
+    Each account (cookie set) gets a cached Playwright storage_state snapshot
+    (cookies + localStorage) that new contexts are created from, so Gemini
+    does not re-bootstrap its session on every page load. Snapshots are
+    persisted under `state_dir` and refreshed periodically from a logged-in page.
+
+    The pool is bound to the event loop it is started on. Sync hosts (or
+    Windows servers whose loop cannot spawn subprocesses) use start_background()
+    to run it on a dedicated loop thread; callers on any loop go through run().
+    """
+
+    def __init__(self, firefox_path: Optional[str] = None, headless: bool = True,
+                 state_dir: str = "./state", refresh_interval: float = 1800.0,
+                 max_contexts: int = 4, warm_contexts: int = 0, warm_max_age: float = 600.0):
+        self.firefox_path = firefox_path
+        self.headless = headless
+        self.state_dir = Path(state_dir)
+        self.refresh_interval = refresh_interval
+        self.max_contexts = max_contexts
+        self.warm_contexts = warm_contexts
+        self.warm_max_age = warm_max_age
+
+        self._playwright = None
+        self._browser = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._snapshots: Dict[str, Dict[str, Any]] = {}    # account -> storage_state
+        self._snapshot_ts: Dict[str, float] = {}           # account -> time captured
+        self._cookies: Dict[str, List[Dict[str, Any]]] = {}  # account -> seed cookies
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._warm: Dict[str, deque] = {}                  # account -> (created, context, page) already on GEMINI_APP_URL; each holds a slot
+        self._refills: set = set()
+        self._filling: set = set()                         # accounts with a prefill in progress
+
+    # ---- lifecycle ----
+    @property
+    def started(self) -> bool:
+        return self._browser is not None
+
+    async def start(self):
+        if self.started: return
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.max_contexts)
+        self.state_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.firefox.launch(executable_path=self.firefox_path, headless=self.headless)
+        if self.refresh_interval > 0:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+        logger.info(f"Browser pool started (headless={self.headless}, max_contexts={self.max_contexts})")
+
+    async def close(self):
+        for t in list(self._refills): t.cancel()
+        for warm in self._warm.values():
+            while warm:
+                _, context, _ = warm.popleft()
+                await self._discard(context)
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try: await self._refresh_task
+            except asyncio.CancelledError: pass
+            self._refresh_task = None
+        if self._browser:
+            try: await self._browser.close()
+            except Exception as e: logger.warning(f"Error closing browser: {e}")
+            self._browser = None
+        if self._playwright:
+            await self._playwright.stop()
+            self._playwright = None
+        logger.info("Browser pool closed")
+
+    def start_background(self, timeout: float = 60.0):
+        """Start the pool on its own event loop thread and wait until the browser is up."""
+        if self._thread: return
+        ready = threading.Event()
+        error: Dict[str, BaseException] = {}
+
+        def _run():
+            if platform.system() == 'Windows':
+                try: asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+                except AttributeError: pass
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                loop.run_until_complete(self.start())
+            except BaseException as e:
+                error["e"] = e
+                ready.set()
+                loop.close()
+                return
+            ready.set()
+            try: loop.run_forever()
+            finally: loop.close()
+
+        self._thread = threading.Thread(target=_run, name="browser-pool", daemon=True)
+        self._thread.start()
+        if not ready.wait(timeout):
+            raise TimeoutError("Browser pool did not start in time")
+        if "e" in error:
+            self._thread = None
+            raise error["e"]
+
+    def stop_background(self, timeout: float = 30.0):
+        if not self._thread or not self._loop: return
+        try:
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"Error stopping browser pool: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, fn: Callable[[], Awaitable[Any]]):
+        """Schedule fn() on the pool loop from any thread; returns a concurrent.futures.Future."""
+        if not self._loop: raise RuntimeError("Browser pool is not started")
+        return asyncio.run_coroutine_threadsafe(fn(), self._loop)
+
+    async def run(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await fn() on the pool loop, whichever loop the caller is on."""
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        if current is self._loop:
+            return await fn()
+        return await asyncio.wrap_future(self.submit(fn))
+
+    # ---- snapshots ----
+    def _state_path(self, account: str) -> Path:
+        return self.state_dir / f"{account}.json"
+
+    def _lock(self, account: str) -> asyncio.Lock:
+        if account not in self._locks: self._locks[account] = asyncio.Lock()
+        return self._locks[account]
+
+    def _load_snapshot(self, account: str) -> Optional[Dict[str, Any]]:
+        if account in self._snapshots: return self._snapshots[account]
+        path = self._state_path(account)
+        if path.exists():
+            try:
+                self._snapshots[account] = json.loads(path.read_text(encoding="utf-8"))
+                self._snapshot_ts[account] = path.stat().st_mtime
+                logger.info(f"Loaded storage_state snapshot for account {account}")
+                return self._snapshots[account]
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+    def _save_snapshot(self, account: str, state: Dict[str, Any]):
+        self._snapshots[account] = state
+        self._snapshot_ts[account] = time.time()
+        path = self._state_path(account)
+        tmp = path.with_suffix(".tmp")
+        # Snapshots hold live session cookies: owner-only, whatever the umask (or a leftover .tmp's mode)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if hasattr(os, "fchmod"): os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json.dumps(state))
+        os.replace(tmp, path)
+
+    async def refresh_snapshot(self, account: str, cookies: Optional[List[Dict[str, Any]]] = None) -> bool:
+        """Load Gemini in a fresh context and capture its storage_state. Returns False if signed out."""
+        if cookies: self._cookies[account] = cookies
+        async with self._lock(account):
+            state = self._load_snapshot(account)
+            await self._acquire_slot()
+            try:
+                context = await self._browser.new_context(storage_state=state) if state else await self._browser.new_context()
+            except BaseException:
+                self._slots.release()
+                raise
+            try:
+                # The snapshot already carries the session's current cookies; re-adding the seed would roll them back
+                seed = self._cookies.get(account)
+                if seed and state is None: await context.add_cookies(seed)
+                page = await context.new_page()
+                await page.goto(GEMINI_APP_URL)
+                try:
+                    if await page.locator(SIGN_IN_SELECTOR).is_visible(timeout=5000):
+                        logger.warning(f"Account {account} is not signed in; snapshot not refreshed")
+                        return False
+                except Exception:
+                    pass
+                self._save_snapshot(account, await context.storage_state())
+                logger.info(f"Refreshed storage_state snapshot for account {account}")
+                return True
+            finally:
+                await self._discard(context)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for account in list(self._snapshots):
+                if time.time() - self._snapshot_ts.get(account, 0) < self.refresh_interval: continue
+                try: await self.refresh_snapshot(account)
+                except asyncio.CancelledError: raise
+                except Exception as e: logger.warning(f"Snapshot refresh failed for {account}: {e}")
+
+    # ---- contexts ----
+    async def _new_context(self, account: str, cookies: Optional[List[Dict[str, Any]]]):
+        state = self._snapshots.get(account)
+        context = await self._browser.new_context(storage_state=state) if state else await self._browser.new_context()
+        if cookies and state is None: await context.add_cookies(cookies)
+        return context
+
+    async def _ensure_snapshot(self, account: str, cookies: Optional[List[Dict[str, Any]]]):
+        if cookies and account not in self._cookies and self._load_snapshot(account) is None:
+            await self.refresh_snapshot(account, cookies)
+
+    async def _discard(self, context):
+        """Close a context that holds a slot and give the slot back."""
+        try: await context.close()
+        except Exception: pass
+        finally: self._slots.release()
+
+    async def prefill(self, cookies: Optional[List[Dict[str, Any]]]) -> int:
+        """
+        Open contexts with Gemini already loaded, up to `warm_contexts`. Returns how many are warm.
+        Warm contexts count against `max_contexts`, so only free slots are filled; requests come first.
+        """
+        account = account_key(cookies) if cookies else "anonymous"
+        await self._ensure_snapshot(account, cookies)
+        warm = self._warm.setdefault(account, deque())
+        if account in self._filling: return len(warm)
+        self._filling.add(account)
+        try:
+            # locked() is also true while requests are queued for a slot
+            while len(warm) < self.warm_contexts and not self._slots.locked():
+                await self._slots.acquire()
+                try:
+                    context = await self._new_context(account, cookies)
+                except BaseException:
+                    self._slots.release()
+                    raise
+                try:
+                    page = await context.new_page()
+                    await page.goto(GEMINI_APP_URL)
+                except BaseException:
+                    await self._discard(context)
+                    raise
+                warm.append((time.monotonic(), context, page))
+        finally:
+            self._filling.discard(account)
+        return len(warm)
+
+    def warm_count(self, cookies: Optional[List[Dict[str, Any]]]) -> int:
+        return len(self._warm.get(account_key(cookies) if cookies else "anonymous", ()))
+
+    async def _take_warm(self, account: str):
+        warm = self._warm.get(account)
+        while warm:
+            created, context, page = warm.popleft()
+            if time.monotonic() - created < self.warm_max_age and not page.is_closed():
+                return context, page
+            await self._discard(context)
+        return None
+
+    async def _acquire_slot(self):
+        """Take a context slot, first closing the oldest idle warm context if none is free."""
+        if self._slots.locked():
+            oldest = min((w for w in self._warm.values() if w), key=lambda w: w[0][0], default=None)
+            if oldest is not None:
+                _, context, _ = oldest.popleft()
+                await self._discard(context)
+        await self._slots.acquire()
+
+    def _schedule_refill(self, cookies: Optional[List[Dict[str, Any]]]):
+        async def _refill():
+            try: await self.prefill(cookies)
+            except asyncio.CancelledError: raise
+            except Exception as e: logger.warning(f"Warm context refill failed: {e}")
+        task = asyncio.create_task(_refill())
+        self._refills.add(task)
+        task.add_done_callback(self._refills.discard)
+
+    @asynccontextmanager
+    async def page(self, cookies: List[Dict[str, Any]]):
+        """
+        Yield a page in a fresh context seeded from the account's snapshot; the context is closed on exit.
+        A pre-warmed page (already on the Gemini app) is used when one is available.
+        """
+        if not self.started: raise RuntimeError("Browser pool is not started")
+        account = account_key(cookies) if cookies else "anonymous"
+        await self._ensure_snapshot(account, cookies)
+        # A warm context already holds its slot; otherwise take one
+        warm = await self._take_warm(account)
+        if warm:
+            context, page = warm
+        else:
+            await self._acquire_slot()
+            try:
+                context = await self._new_context(account, cookies)
+            except BaseException:
+                self._slots.release()
+                raise
+        try:
+            yield page if warm else await context.new_page()
+        finally:
+            await self._discard(context)
+            if self.warm_contexts and self.started: self._schedule_refill(cookies)
+
+# ---------------- SHARED ---------------- #
+_shared_pool: Optional[BrowserPool] = None
+
+def get_pool() -> Optional[BrowserPool]:
+    return _shared_pool
+
+def set_pool(pool: Optional[BrowserPool]):
+    global _shared_pool
+    _shared_pool = pool
@@ -0,0 +1,91 @@
+import asyncio, time, logging, threading
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+logger = logging.getLogger("gemini-cancel")
+
+class CancelToken:
+    """
+    Thread-safe cancellation flag with an optional deadline, shared by the
+    request handler and whatever runs the request (threads or event loops).
+
+    Callbacks registered with on_cancel() fire once, on cancel(); use them to
+    abort blocking work such as closing an upstream stream.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+        self._callbacks: List[Callable[[], Any]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline exceeded")
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the deadline (None if there is none)."""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set(): return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for cb in callbacks:
+            try: cb()
+            except Exception as e: logger.debug(f"Cancel callback failed: {e}")
+
+    def on_cancel(self, cb: Callable[[], Any]):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(cb)
+                return
+        cb()
+
+def bounded_timeout(token: Optional[CancelToken], default: float) -> float:
+    """`default` seconds, shortened to the token's remaining time."""
+    remaining = token.remaining() if token else None
+    return default if remaining is None else min(default, remaining)
+
+async def run_until_disconnect(request, work: Callable[[], Awaitable[Any]], token: CancelToken,
+                               poll_interval: float = 0.5) -> Tuple[Optional[Any], Optional[str]]:
+    """
+    Run work() while watching for a client disconnect or the token's deadline.
+
+    On either, the token is cancelled (firing its callbacks) and the task is
+    cancelled, so pool pages close and upstream streams are dropped right away.
+    Returns (result, None) or (None, reason).
+    """
+    task = asyncio.ensure_future(work())
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                try:
+                    result = task.result()
+                except (asyncio.TimeoutError, TimeoutError):
+                    # A backend's own wait_for, bounded by the same deadline, fired before this poll
+                    if not token.cancelled: raise
+                    break
+                # Work that gave up because of the token reports the abort, not its own error
+                if token.cancelled and not (isinstance(result, dict) and result.get("status") == "success"):
+                    break
+                return result, None
+            if await request.is_disconnected():
+                token.cancel("client disconnected")
+            if token.cancelled:
+                break
+    except asyncio.CancelledError:
+        token.cancel("server cancelled")
+        raise
+    finally:
+        if not task.done():
+            task.cancel()
+            try: await task
+            except BaseException: pass
+    logger.info(f"Request to {request.url.path} aborted: {token.reason}")
+    return None, token.reason
@@ -1,14 +1,13 @@
-import asyncio, sys, os, time, json, logging, argparse, threading, http.server, socketserver, socket, concurrent.futures, platform
+import asyncio, sys, os, time, json, logging, argparse, threading, platform, signal, mimetypes
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs
-from typing import Dict, Any, Tuple
+from urllib.parse import urlparse, parse_qs, unquote
+from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 from playwright.async_api import async_playwright
 from cookie_helpers import parse_cookies, is_running_in_docker
-import threading
-import functools
-import platform
-import asyncio as _asyncio
+from browser_pool import BrowserPool
+from media import media_filename
+from cancellation import CancelToken, bounded_timeout
 
 # Fix for Windows Playwright subprocess issues
 if platform.system() == 'Windows':
@@ -30,69 +29,228 @@ def get_firefox_path():
         if Path(path).exists(): return path
     raise FileNotFoundError("Firefox not found. Set FIREFOX_BIN env var.")
 
-def start_http_server(port=8080) -> Tuple[socketserver.TCPServer, int]:
-    class Handler(http.server.SimpleHTTPRequestHandler):
-        def do_GET(self):
-            parsed = urlparse(self.path)
-            if parsed.path == "/headless":
-                params = parse_qs(parsed.query)
-                prompt = params.get("prompt", [""])[0]
-                # run_headless is async; run it safely on Windows
-                try:
-                    # Check if we're on Windows and set event loop policy if needed
-                    if platform.system() == 'Windows':
-                        try:
-                            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-                        except AttributeError:
-                            pass
-                    
-                    try:
-                        result = asyncio.run(run_headless({"prompt": prompt, "no_headless": False}))
-                    except RuntimeError as e:
-                        if "cannot be called from a running event loop" in str(e):
-                            # If an event loop is already running, create a new one in a thread
-                            import threading
-                            result_container = {}
-                            def run_in_thread():
-                                if platform.system() == 'Windows':
-                                    try:
-                                        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-                                    except AttributeError:
-                                        pass
-                                loop = asyncio.new_event_loop()
-                                asyncio.set_event_loop(loop)
-                                try:
-                                    result_container['result'] = loop.run_until_complete(run_headless({"prompt": prompt, "no_headless": False}))
-                                finally:
-                                    loop.close()
-                            
-                            t = threading.Thread(target=run_in_thread)
-                            t.start()
-                            t.join()
-                            result = result_container.get('result', {"status": "error", "errors": ["Failed to run in thread"]})
-                        else:
-                            raise
-                except Exception as e:
-                    result = {"status": "error", "errors": [str(e)]}
-                
-                self.send_response(200)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps(result).encode())
-            elif parsed.path == "/stream_log":
-                log_content = Path("stream_full.log").read_text(encoding="utf-8") if Path("stream_full.log").exists() else ""
-                self.send_response(200); self.send_header("Content-Type", "application/json"); self.end_headers()
-                self.wfile.write(json.dumps({"log": log_content}).encode())
-            else: super().do_GET()
-    for test_port in range(port, port+10):
+# ------------------- HTTP sidecar -------------------
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 503: "Service Unavailable"}
+
+class HeadlessHTTPServer:
+    """
+    Concurrent /headless sidecar on one asyncio loop.
+
+    Requests share a single event loop and one reusable BrowserPool; at most
+    `max_concurrency` prompts run at once and the rest wait their turn. On
+    shutdown the listener closes first, in-flight pages get `drain_timeout`
+    seconds to finish, and anything left is cancelled (closing its page).
+    """
+
+    def __init__(self, port: int = 8080, max_concurrency: int = 4, drain_timeout: float = 30.0,
+                 cookies: Optional[str] = None, cookies_file: Optional[str] = None, headless: bool = True):
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.drain_timeout = drain_timeout
+        self.cookies = cookies
+        self.cookies_file = cookies_file
+        # No display in a container, whatever the caller asked for
+        self.headless = headless or is_running_in_docker()
+        self.pool: Optional[BrowserPool] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+        self._stopping: Optional[asyncio.Event] = None
+
+    async def start(self) -> int:
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._stopping = asyncio.Event()
+        self.pool = BrowserPool(firefox_path=get_firefox_path(), headless=self.headless,
+                                max_contexts=self.max_concurrency,
+                                state_dir=os.getenv('STORAGE_STATE_DIR', './state'),
+                                refresh_interval=float(os.getenv('STORAGE_STATE_REFRESH', '1800')))
+        await self.pool.start()
+        # Binding is the probe: take the first free port directly instead of test-bind-then-rebind
+        for test_port in range(self.port, self.port + 10):
+            try:
+                self._server = await asyncio.start_server(self._on_connection, "", test_port)
+                self.port = test_port
+                break
+            except OSError:
+                continue
+        else:
+            await self.pool.close()
+            raise OSError(f"No free port in {self.port}-{self.port + 9}")
+        logger.info(f"Headless HTTP server listening on port {self.port} (max_concurrency={self.max_concurrency})")
+        return self.port
+
+    def request_stop(self):
+        if self._stopping: self._stopping.set()
+
+    async def serve_forever(self):
+        await self._stopping.wait()
+
+    async def shutdown(self):
+        # Stop accepting first, but only wait for the listener after draining: on Python 3.12+
+        # wait_closed() also waits for open connections, which would bypass drain_timeout
+        if self._server: self._server.close()
+        if self._tasks:
+            logger.info(f"Draining {len(self._tasks)} in-flight requests (up to {self.drain_timeout:g}s)")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+            for t in pending: t.cancel()
+            if pending: await asyncio.gather(*pending, return_exceptions=True)
+        if self._server:
+            await self._server.wait_closed()
+            self._server = None
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def _on_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._tasks.add(task)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s: s.bind(("", test_port)); port=test_port; break
-        except OSError: continue
-    httpd = socketserver.TCPServer(("", port), Handler)
-    threading.Thread(target=httpd.serve_forever, daemon=True).start()
-    return httpd, port
+            await self._handle(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"Error handling request: {e}", exc_info=True)
+        finally:
+            self._tasks.discard(task)
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=30)
+        except asyncio.LimitOverrunError:
+            return await self._send(writer, 413, {"status": "error", "errors": ["Request header too large"]})
+        except asyncio.TimeoutError:
+            return
+        try:
+            method, target, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+        except ValueError:
+            return await self._send(writer, 400, {"status": "error", "errors": ["Malformed request line"]})
+        if method != "GET":
+            return await self._send(writer, 405, {"status": "error", "errors": ["Only GET is supported"]})
+
+        parsed = urlparse(target)
+        if parsed.path == "/headless":
+            if self._stopping.is_set():
+                return await self._send(writer, 503, {"status": "error", "errors": ["Server shutting down"]})
+            prompt = parse_qs(parsed.query).get("prompt", [""])[0]
+            if not prompt.strip():
+                return await self._send(writer, 400, {"status": "error", "errors": ["prompt is required"]})
+            async with self._slots:
+                result = await run_headless({"prompt": prompt, "no_headless": not self.headless, "pool": self.pool,
+                                             "cookies": self.cookies, "cookies_file": self.cookies_file})
+            await self._send(writer, 200, result)
+        elif parsed.path == "/stream_log":
+            log_content = Path("stream_full.log").read_text(encoding="utf-8") if Path("stream_full.log").exists() else ""
+            await self._send(writer, 200, {"log": log_content})
+        elif parsed.path.startswith("/output/"):
+            # Only generated media is served; the rest of the working directory (.env, cookies) is not
+            name = Path(unquote(parsed.path[len("/output/"):])).name
+            path = Path("output", name)
+            if not name or not path.is_file():
+                return await self._send(writer, 404, {"status": "error", "errors": ["Not found"]})
+            ctype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            await self._send_bytes(writer, 200, await asyncio.to_thread(path.read_bytes), ctype)
+        else:
+            await self._send(writer, 404, {"status": "error", "errors": ["Not found"]})
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, body: Dict[str, Any]):
+        await self._send_bytes(writer, status, json.dumps(body).encode(), "application/json")
+
+    async def _send_bytes(self, writer: asyncio.StreamWriter, status: int, body: bytes, ctype: str):
+        writer.write((f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                      f"Content-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+                      f"Connection: close\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+async def serve_http(port: int = 8080, **kwargs):
+    server = HeadlessHTTPServer(port, **kwargs)
+    port = await server.start()
+    print(f"HTTP server running at http://localhost:{port}/headless?prompt=hi")
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, server.request_stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: KeyboardInterrupt cancels serve_forever and shutdown still runs below
+    try:
+        await server.serve_forever()
+    finally:
+        await server.shutdown()
 
 # ------------------- Core -------------------
+async def _chat_on_page(page, prompt: str, cancel: Optional[CancelToken] = None) -> Dict[str, Any]:
+    # Pre-warmed pool pages are already on the app
+    if not page.url.startswith("https://gemini.google.com/app"):
+        await page.goto("https://gemini.google.com/app")
+
+    # Check if user is signed in by looking for sign-in elements
+    try:
+        # Look for sign-in link with Google ServiceLogin URL - if visible, user is not signed in
+        sign_in_visible = await page.locator("a[href*='accounts.google.com/ServiceLogin']").is_visible(timeout=5000)
+        if sign_in_visible:
+            return {"status":"error","errors":["Not signed in"]}
+    except Exception:
+        # If we can't find sign-in elements, assume user is signed in and continue
+        logger.info("Could not detect sign-in status, proceeding...")
+
+    # Updated selector for the input box based on current Gemini interface
+    box = page.locator("div.ql-editor.textarea.new-input-ui[contenteditable='true']")
+    await box.fill(prompt); await page.keyboard.press("Enter")
+
+    # Wait longer for response generation and look for image buttons to appear
+    logger.info("Waiting for Gemini response...")
+    await asyncio.sleep(bounded_timeout(cancel, 10))  # Increased wait time
+
+    # Wait for image buttons to appear (indicating response is ready)
+    try:
+        # 2 minute timeout, or whatever is left of the request deadline (0 would mean "no timeout")
+        await page.wait_for_selector("button.image-button", timeout=max(1, bounded_timeout(cancel, 120) * 1000))
+        logger.info("Image buttons detected - response ready")
+    except Exception:  # not bare: a cancelled request must not fall through to scraping
+        logger.warning("No image buttons found within timeout, proceeding anyway")
+        # Wait a bit more for text response
+        await asyncio.sleep(bounded_timeout(cancel, 5))
+
+    # Get text response using more comprehensive selectors
+    resp_elems = await page.locator('[data-message-author-role="model"], message-content p, .model-response-text, .response-container p').all()
+    text = " ".join([await e.text_content() or "" for e in resp_elems]).strip()
+    logger.info(f"Extracted text response: {text[:100]}..." if text else "No text response found")
+
+    # Get images using the updated selector
+    imgs, media = await page.locator("button.image-button img").all(), []
+    logger.info(f"Found {len(imgs)} images to download")
+
+    for i, img in enumerate(imgs[:5], 1):
+        src = await img.get_attribute("src")
+        if not src: 
+            logger.warning(f"Image {i}: No src attribute found")
+            continue
+
+        logger.info(f"Downloading image {i}")
+        data = await page.request.get(src)
+        if data.ok:
+            body = await data.body()
+            # Named by content hash (extension by magic bytes): concurrent chats never overwrite each other
+            filename = media_filename(body)
+            Path("output").mkdir(exist_ok=True)
+            Path("output",filename).write_bytes(body)
+            media.append(filename)
+            logger.info(f"Successfully saved image: {filename}")
+            logger.info(f"Image accessible at: http://localhost:8080/output/{filename}")
+        else:
+            logger.error(f"Failed to download image {i}: HTTP {data.status}")
+
+    Path("stream_full.log").write_text(text, encoding="utf-8")
+
+    result = {"status":"success","data":{"response":text,"media":media}}
+    logger.info(f"Final result: {len(media)} images, text length: {len(text)}")
+    return result
+
 async def run_headless(args: Dict[str, Any]) -> Dict[str, Any]:
     firefox = get_firefox_path()
     prompt = args.get("prompt","")
@@ -120,76 +278,28 @@ async def run_headless(args: Dict[str, Any]) -> Dict[str, Any]:
     cookies = parse_cookies(args.get("cookies"), args.get("cookies_file"))
     if is_running_in_docker() and not cookies:
         return {"status":"error","errors":["Docker requires cookies"]}
+    pool = args.get("pool")
+    if pool is not None and pool.started:
+        # Shared browser: a lightweight context seeded from the account's storage_state snapshot
+        async def _pooled_flow():
+            async with pool.page(cookies) as page:
+                return await _chat_on_page(page, prompt, args.get("cancel"))
+        try:
+            return await pool.run(_pooled_flow)
+        except Exception as e:
+            logger.error(f"Unexpected error in pooled run_headless: {e}")
+            return {"status": "error", "errors": [str(e)]}
+
     async def _playwright_flow():
         async with async_playwright() as p:
             browser = await p.firefox.launch(executable_path=firefox, headless=not no_headless)
             context = await browser.new_context()
             if cookies: await context.add_cookies(cookies)
             page = await context.new_page()
-            await page.goto("https://gemini.google.com/app")
-            
-            # Check if user is signed in by looking for sign-in elements
-            try:
-                # Look for sign-in link with Google ServiceLogin URL - if visible, user is not signed in
-                sign_in_visible = await page.locator("a[href*='accounts.google.com/ServiceLogin']").is_visible(timeout=5000)
-                if sign_in_visible:
-                    await context.close()
-                    return {"status":"error","errors":["Not signed in"]}
-            except:
-                # If we can't find sign-in elements, assume user is signed in and continue
-                logger.info("Could not detect sign-in status, proceeding...")
-                
-            # Updated selector for the input box based on current Gemini interface
-            box = page.locator("div.ql-editor.textarea.new-input-ui[contenteditable='true']")
-            await box.fill(prompt); await page.keyboard.press("Enter")
-            
-            # Wait longer for response generation and look for image buttons to appear
-            logger.info("Waiting for Gemini response...")
-            await asyncio.sleep(10)  # Increased wait time
-            
-            # Wait for image buttons to appear (indicating response is ready)
             try:
-                await page.wait_for_selector("button.image-button", timeout=120000)  # 2 minute timeout
-                logger.info("Image buttons detected - response ready")
-            except:
-                logger.warning("No image buttons found within timeout, proceeding anyway")
-                # Wait a bit more for text response
-                await asyncio.sleep(5)
-            
-            # Get text response using more comprehensive selectors
-            resp_elems = await page.locator('[data-message-author-role="model"], message-content p, .model-response-text, .response-container p').all()
-            text = " ".join([await e.text_content() or "" for e in resp_elems]).strip()
-            logger.info(f"Extracted text response: {text[:100]}..." if text else "No text response found")
-            
-            # Get images using the updated selector
-            imgs, media = await page.locator("button.image-button img").all(), []
-            logger.info(f"Found {len(imgs)} images to download")
-            
-            for i, img in enumerate(imgs[:5], 1):
-                src = await img.get_attribute("src")
-                if not src: 
-                    logger.warning(f"Image {i}: No src attribute found")
-                    continue
-                    
-                filename = f"gemini_image_{int(time.time())}_{i}.jpg"
-                logger.info(f"Downloading image {i}: {filename}")
-                
-                data = await page.request.get(src)
-                if data.ok:
-                    Path("output").mkdir(exist_ok=True)
-                    Path("output",filename).write_bytes(await data.body())
-                    media.append(filename)
-                    logger.info(f"Successfully saved image: {filename}")
-                    logger.info(f"Image accessible at: http://localhost:8080/output/{filename}")
-                else:
-                    logger.error(f"Failed to download image {i}: HTTP {data.status}")
-                    
-            await context.close()
-            Path("stream_full.log").write_text(text, encoding="utf-8")
-            
-            result = {"status":"success","data":{"response":text,"media":media}}
-            logger.info(f"Final result: {len(media)} images, text length: {len(text)}")
-            return result
+                return await _chat_on_page(page, prompt, args.get("cancel"))
+            finally:
+                await context.close()
 
     try:
         # Try running Playwright in the current loop (typical async server case)
@@ -233,6 +343,8 @@ def main():
     parser.add_argument("--prompt"); parser.add_argument("--no-headless", action="store_true")
     parser.add_argument("--cookies"); parser.add_argument("--cookies-file"); parser.add_argument("--serve-http", action="store_true")
     parser.add_argument("--http-port", type=int, default=8080)
+    parser.add_argument("--max-concurrency", type=int, default=int(os.getenv("HEADLESS_MAX_CONCURRENCY", "4")))
+    parser.add_argument("--drain-timeout", type=float, default=float(os.getenv("HEADLESS_DRAIN_TIMEOUT", "30")))
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -245,11 +357,13 @@ def main():
             pass
     
     if args.serve_http:
-        httpd, port = start_http_server(args.http_port)
-        print(f"HTTP server running at http://localhost:{port}/headless?prompt=hi")
-        try: 
-            while True: time.sleep(1)
-        except KeyboardInterrupt: httpd.shutdown()
+        headless = not args.no_headless and os.getenv('HEADLESS', 'true').lower() != 'false'
+        try:
+            asyncio.run(serve_http(args.http_port, max_concurrency=args.max_concurrency, drain_timeout=args.drain_timeout,
+                                   cookies=args.cookies, cookies_file=args.cookies_file,
+                                   headless=headless or is_running_in_docker()))
+        except KeyboardInterrupt:
+            pass
     else:
         if not args.prompt: parser.error("--prompt required unless --serve-http")
         # run_headless is async; use asyncio.run when invoked from CLI
@@ -1,9 +1,9 @@
-import asyncio, platform, sys, os, logging, json, time, threading, concurrent.futures
+import asyncio, platform, sys, os, logging, json, time, hashlib, hmac
 from pathlib import Path
+from typing import Optional
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from pydantic import BaseModel
@@ -14,8 +14,15 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Import main functions
-from main import run_main
-from headless import run_headless
+from browser_pool import get_pool, set_pool
+from backends import run_http_backend, run_browser_backend
+from warmup import warmup_from_env
+from cancellation import CancelToken, run_until_disconnect
+from profiling import profile_cpu, profile_memory, ProfilerBusy
+from router import AdaptiveRouter
+from jobs import JobQueue, WorkerPool, JOB_KINDS, MAX_JOB_ATTEMPTS, MAX_JOB_PRIORITY
+from ratelimit import ClientLimiter
+from media import VariantCache, VARIANT_FORMATS, MAX_VARIANT_WIDTH, format_supported, sniff_content_type, is_content_named
 
 # Logging
 logger = logging.getLogger("gemini-api")
@@ -43,6 +50,17 @@ def display_banner():
     print("\n" + "Telegram: https://t.me/codiifycoders".center(80))
     print("GitHub: https://github.com/codiifycoders".center(80) + "\n")
 
+# Durable job queue (POST /jobs)
+job_queue = JobQueue(
+    os.getenv('JOBS_DB', 'jobs.db'),
+    lease=float(os.getenv('JOB_LEASE', '600')),
+    result_ttl=float(os.getenv('JOB_RESULT_TTL', '86400')),
+)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+
+# Startup pre-warming (WARMUP_STEPS)
+warmup = warmup_from_env()
+
 # FastAPI lifespan with environment validation
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -52,15 +70,73 @@ async def lifespan(app: FastAPI):
     if not os.getenv('GEMINI_COOKIES') and not os.getenv('GEMINI_COOKIES_FILE'):
         logger.warning("No GEMINI_COOKIES or GEMINI_COOKIES_FILE configured. API may not work properly.")
     
+    # Warm DNS/TLS, cookies, the shared browser and its pages in the background; /readyz reports progress
+    warmup.start()
+    
+    # Background job workers consuming the SQLite queue
+    workers = None
+    if JOB_WORKERS > 0:
+        workers = WorkerPool(job_queue.path, workers=JOB_WORKERS, lease=job_queue.lease, result_ttl=job_queue.result_ttl)
+        workers.start()
+    
     logger.info("API started")
     yield
     logger.info("API shutting down")
+    await warmup.stop()
+    if workers:
+        await asyncio.to_thread(workers.stop)
+    pool = get_pool()
+    if pool:
+        set_pool(None)
+        await asyncio.to_thread(pool.stop_background)
 
 app = FastAPI(lifespan=lifespan)
 
 # CORS + static
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-app.mount("/output", StaticFiles(directory="output"), name="output")
+# Per-client rate limiting (API key, else IP) on the generation endpoints
+client_limiter = ClientLimiter(
+    rate=float(os.getenv('RATE_LIMIT_PER_MINUTE', '30')) / 60,
+    burst=float(os.getenv('RATE_LIMIT_BURST', '10')),
+)
+RATE_LIMITED_PATHS = {"/api", "/browser", "/generate", "/jobs"}
+# Only keys listed in API_KEYS get their own bucket; anything else is limited by IP,
+# so rotating made-up X-API-Key values cannot mint fresh budgets
+API_KEYS = {k.strip() for k in os.getenv('API_KEYS', '').split(',') if k.strip()}
+
+def client_key(request: Request) -> str:
+    api_key = request.headers.get("x-api-key")
+    if api_key and any(hmac.compare_digest(api_key.encode(), k.encode()) for k in API_KEYS):
+        return "key:" + hashlib.sha1(api_key.encode()).hexdigest()[:16]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+@app.middleware("http")
+async def rate_limit(request: Request, call_next):
+    if request.method != "POST" or request.url.path not in RATE_LIMITED_PATHS:
+        return await call_next(request)
+    request.state.client_key = client_key(request)
+    allowed, headers = client_limiter.check(request.state.client_key)
+    if not allowed:
+        logger.warning(f"Rate limited {request.state.client_key} on {request.url.path}")
+        return JSONResponse(status_code=429, content={"status":"error","error":"Rate limit exceeded"}, headers=headers)
+    response = await call_next(request)
+    response.headers.update(headers)
+    return response
+
+
+# Generated media: originals plus resized / re-encoded variants from a bounded disk cache
+media_cache = VariantCache(
+    "output",
+    cache_dir=os.getenv('MEDIA_CACHE_DIR', 'media_cache'),
+    max_bytes=int(float(os.getenv('MEDIA_CACHE_MAX_MB', '256')) * 1024 * 1024),
+    quality=int(os.getenv('MEDIA_QUALITY', '80')),
+)
+MEDIA_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Older timestamp-named files can be replaced under the same name: cacheable, but always revalidated
+MEDIA_REVALIDATE = "public, no-cache"
+
+def media_cache_control(name: str) -> str:
+    return MEDIA_CACHE_CONTROL if is_content_named(name) else MEDIA_REVALIDATE
 
 # Models with validation
 class ApiRequest(BaseModel): 
@@ -84,6 +160,65 @@ class BrowserRequest(BaseModel):
         if len(self.prompt) > 10000:
             raise ValueError("Prompt too long (max 10000 characters)")
 
+class GenerateRequest(BaseModel): 
+    prompt: str
+    at_token: Optional[str] = None
+    want_media: bool = False
+    
+    def __init__(self, **data):
+        super().__init__(**data)
+        if not self.prompt.strip():
+            raise ValueError("Prompt cannot be empty")
+        if len(self.prompt) > 10000:
+            raise ValueError("Prompt too long (max 10000 characters)")
+
+class JobRequest(BaseModel):
+    prompt: str
+    kind: str = "generate"
+    at_token: Optional[str] = None
+    want_media: bool = False
+    priority: int = 0
+    max_attempts: int = 3
+    webhook_url: Optional[str] = None
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        if not self.prompt.strip():
+            raise ValueError("Prompt cannot be empty")
+        if len(self.prompt) > 10000:
+            raise ValueError("Prompt too long (max 10000 characters)")
+        if self.kind not in JOB_KINDS:
+            raise ValueError(f"kind must be one of {', '.join(JOB_KINDS)}")
+        if self.kind == "api" and not self.at_token:
+            raise ValueError("at_token is required for api jobs")
+        if not 1 <= self.max_attempts <= MAX_JOB_ATTEMPTS:
+            raise ValueError(f"max_attempts must be between 1 and {MAX_JOB_ATTEMPTS}")
+        if not -MAX_JOB_PRIORITY <= self.priority <= MAX_JOB_PRIORITY:
+            raise ValueError(f"priority must be between {-MAX_JOB_PRIORITY} and {MAX_JOB_PRIORITY}")
+
+router = AdaptiveRouter(
+    {"http": run_http_backend, "browser": run_browser_backend},
+    window=int(os.getenv('ROUTER_WINDOW', '50')),
+    explore=float(os.getenv('ROUTER_EXPLORE', '0.05')),
+    costs={"browser": float(os.getenv('ROUTER_BROWSER_COST', '10'))},
+)
+
+# Per-request deadline (REQUEST_TIMEOUT, or shorter via X-Request-Timeout) and disconnect handling
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '300'))
+
+def request_token(request: Request) -> CancelToken:
+    timeout = REQUEST_TIMEOUT
+    try:
+        timeout = min(timeout, float(request.headers.get("x-request-timeout", timeout)))
+    except ValueError:
+        pass
+    return CancelToken(max(timeout, 1.0))
+
+def aborted_response(reason: str) -> JSONResponse:
+    # 499 "client closed request" is only for the logs; a client that hit its deadline gets 504
+    status_code = 504 if reason == "deadline exceeded" else 499
+    return JSONResponse(status_code=status_code, content={"status":"error","error":f"Request aborted: {reason}"})
+
 # Endpoints
 @app.get("/")
 async def root():
@@ -93,23 +228,32 @@ async def root():
         "endpoints": {
             "/api": "Gemini API request",
             "/browser": "Gemini browser automation",
+            "/generate": "Adaptive: HTTP path first, browser fallback",
+            "/jobs": "Queue a generation; poll /jobs/{job_id} or use webhook_url",
             "/logs": "Get logs",
+            "/healthz": "Liveness probe",
+            "/readyz": "Readiness probe (warm-up finished)",
             "/docs": "API docs"
         },
         "usage": {
             "api": {"required": ["prompt","at_token"]},
-            "browser": {"required": ["prompt"]}
+            "browser": {"required": ["prompt"]},
+            "generate": {"required": ["prompt"], "optional": ["at_token","want_media"]},
+            "jobs": {"required": ["prompt"], "optional": ["kind","at_token","want_media","priority","max_attempts","webhook_url"]}
         },
         "join": "https://telegram.me/codiifycoders"
     }
 
 @app.post("/api")
-async def api_endpoint(req: ApiRequest):
+async def api_endpoint(req: ApiRequest, request: Request):
     try:
         args = req.dict()
+        args['client'] = request.state.client_key
+        args['cancel'] = token = request_token(request)
         
         # Use the simplified run_main from main.py (no cookies_file parameter needed)
-        result = run_main(args)
+        result, aborted = await run_until_disconnect(request, lambda: run_http_backend(args), token)
+        if aborted: return aborted_response(aborted)
         return JSONResponse(content=result)
         
     except ValueError as e:
@@ -120,43 +264,12 @@ async def api_endpoint(req: ApiRequest):
         return JSONResponse(status_code=500, content={"status":"error","error":str(e)})
 
 @app.post("/browser")
-async def browser_endpoint(req: BrowserRequest):
+async def browser_endpoint(req: BrowserRequest, request: Request):
     try:
-        args = req.dict()
-        args.update({
-            'cookies': os.getenv('GEMINI_COOKIES'),
-            'cookies_file': os.getenv('GEMINI_COOKIES_FILE'),
-            'public_url': os.getenv('PUBLIC_URL'),
-            'no_headless': os.getenv('HEADLESS','false').lower() == 'false'
-        })
-        
-        # Validate required environment variables for browser endpoint
-        if not args.get('cookies') and not args.get('cookies_file'):
-            logger.warning("No cookies configured for browser endpoint")
-        
-        # Run headless in a separate thread with proper event loop for Windows
-        import threading
-        import concurrent.futures
-        
-        def run_headless_sync():
-            try:
-                if platform.system() == 'Windows':
-                    asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                try:
-                    return loop.run_until_complete(run_headless(args))
-                finally:
-                    loop.close()
-            except Exception as e:
-                logger.error(f"Error in headless execution: {e}", exc_info=True)
-                return {"status": "error", "errors": [str(e)]}
-        
-        # Use thread pool to run the headless function
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(run_headless_sync)
-            result = future.result(timeout=300)  # 5 minute timeout
-        
+        token = request_token(request)
+        args = {**req.dict(), 'client': request.state.client_key, 'cancel': token}
+        result, aborted = await run_until_disconnect(request, lambda: run_browser_backend(args), token)
+        if aborted: return aborted_response(aborted)
         return JSONResponse(content=result)
         
     except ValueError as e:
@@ -166,6 +279,135 @@ async def browser_endpoint(req: BrowserRequest):
         logger.error("Browser error", exc_info=True)
         return JSONResponse(status_code=500, content={"status":"error","error":str(e)})
 
+@app.post("/generate")
+async def generate_endpoint(req: GenerateRequest, request: Request):
+    try:
+        args = req.dict()
+        args['client'] = request.state.client_key
+        args['cancel'] = token = request_token(request)
+        # The HTTP path needs an at_token; without one only the browser can serve the request
+        candidates = ["http", "browser"] if args.get("at_token") else ["browser"]
+        result, aborted = await run_until_disconnect(
+            request, lambda: router.generate(args, candidates=candidates, want_media=req.want_media), token)
+        if aborted: return aborted_response(aborted)
+        status_code = 200 if result.get("status") == "success" else 503 if result.get("upstream_busy") else 502
+        return JSONResponse(status_code=status_code, content=result)
+        
+    except ValueError as e:
+        logger.warning(f"Generate validation error: {e}")
+        return JSONResponse(status_code=400, content={"status":"error","error":str(e)})
+    except Exception as e:
+        logger.error("Generate error", exc_info=True)
+        return JSONResponse(status_code=500, content={"status":"error","error":str(e)})
+
+@app.get("/generate/stats")
+async def generate_stats():
+    return {"status":"success","data":router.snapshot()}
+
+@app.post("/jobs")
+async def create_job(req: JobRequest, request: Request):
+    try:
+        payload = {"prompt": req.prompt, "at_token": req.at_token, "want_media": req.want_media, "client": request.state.client_key}
+        job_id = await asyncio.to_thread(job_queue.enqueue, req.kind, payload, req.priority, req.max_attempts, req.webhook_url)
+        return JSONResponse(status_code=202, content={"status":"success","data":{"job_id":job_id,"status":"queued"}})
+        
+    except ValueError as e:
+        logger.warning(f"Job validation error: {e}")
+        return JSONResponse(status_code=400, content={"status":"error","error":str(e)})
+    except Exception as e:
+        logger.error("Job enqueue error", exc_info=True)
+        return JSONResponse(status_code=500, content={"status":"error","error":str(e)})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status":"error","error":"Job not found"})
+    return {"status":"success","data":job}
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    if not await asyncio.to_thread(job_queue.cancel, job_id):
+        return JSONResponse(status_code=409, content={"status":"error","error":"Job not found or already started"})
+    return {"status":"success","data":{"job_id":job_id,"status":"cancelled"}}
+
+@app.get("/output/{name}")
+async def output_file(name: str, request: Request, w: Optional[int] = None, fmt: Optional[str] = None):
+    src = media_cache.source(name)
+    if src is None:
+        return JSONResponse(status_code=404, content={"status":"error","error":"Not found"})
+    
+    # No variant requested: the original, typed by content since older files are all named .jpg
+    if w is None and fmt is None:
+        etag = '"' + media_cache.key(src, None, "original") + '"'
+        headers = {"ETag": etag, "Cache-Control": media_cache_control(name)}
+        if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        ctype = await asyncio.to_thread(sniff_content_type, src)
+        return FileResponse(src, media_type=ctype, headers=headers)
+    
+    fmt = (fmt or "webp").lower()
+    if fmt == "jpg": fmt = "jpeg"
+    if fmt not in VARIANT_FORMATS:
+        return JSONResponse(status_code=400, content={"status":"error","error":f"fmt must be one of {', '.join(VARIANT_FORMATS)}"})
+    if w is not None and not 1 <= w <= MAX_VARIANT_WIDTH:
+        return JSONResponse(status_code=400, content={"status":"error","error":f"w must be between 1 and {MAX_VARIANT_WIDTH}"})
+    if not format_supported(fmt):
+        return JSONResponse(status_code=501, content={"status":"error","error":f"{fmt} encoding is not available on this server"})
+    
+    etag = '"' + media_cache.key(src, w, fmt) + '"'
+    headers = {"ETag": etag, "Cache-Control": media_cache_control(name)}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    try:
+        path = await asyncio.to_thread(media_cache.get, src, w, fmt)
+    except Exception as e:
+        logger.error(f"Transcoding {name} to {fmt} failed: {e}", exc_info=True)
+        return JSONResponse(status_code=415, content={"status":"error","error":"Could not transcode this file"})
+    return FileResponse(path, media_type=VARIANT_FORMATS[fmt][1], headers=headers)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status":"ok"}
+
+@app.get("/readyz")
+async def readyz():
+    state = warmup.snapshot()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content={"status":"ok" if state["ready"] else "warming","data":state})
+
+# Admin-only diagnostics; disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+MAX_PROFILE_SECONDS = 120
+
+def is_admin(request: Request) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    supplied = request.headers.get("x-admin-token") or request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    return hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+async def run_profiler(request: Request, fn, seconds: float, fmt: str, **kwargs):
+    if not is_admin(request):
+        return JSONResponse(status_code=403, content={"status":"error","error":"Admin token required"})
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return JSONResponse(status_code=400, content={"status":"error","error":f"seconds must be between 0 and {MAX_PROFILE_SECONDS}"})
+    try:
+        # Sampling happens in a worker thread so the event loop keeps serving (and being profiled)
+        result = await asyncio.to_thread(fn, seconds, **kwargs)
+    except ProfilerBusy as e:
+        return JSONResponse(status_code=409, content={"status":"error","error":str(e)})
+    logger.info(f"{fn.__name__} ran for {seconds:g}s")
+    if fmt == "collapsed":
+        return PlainTextResponse(result["collapsed"])
+    return {"status":"success","data":result}
+
+@app.get("/debug/profile")
+async def debug_profile(request: Request, seconds: float = 10, format: str = "json"):
+    return await run_profiler(request, profile_cpu, seconds, format)
+
+@app.get("/debug/memory")
+async def debug_memory(request: Request, seconds: float = 10, limit: int = 25, format: str = "json"):
+    return await run_profiler(request, profile_memory, seconds, format, limit=max(1, min(limit, 200)))
+
 @app.get("/logs")
 async def get_logs():
     try:
@@ -0,0 +1,331 @@
+import os, asyncio, json, time, uuid, socket, sqlite3, ipaddress, logging, multiprocessing
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlsplit
+import requests
+
+logger = logging.getLogger("gemini-jobs")
+
+JOB_KINDS = ("generate", "api", "browser")
+# Bounds on client-supplied job settings
+MAX_JOB_ATTEMPTS = 10
+MAX_JOB_PRIORITY = 10
+
+# Optional comma-separated allow-list of webhook hosts; when set, no other host is called
+WEBHOOK_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv('WEBHOOK_ALLOWED_HOSTS', '').split(',') if h.strip()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    webhook_url TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    available_at REAL NOT NULL,
+    locked_until REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, priority DESC, created_at);
+CREATE INDEX IF NOT EXISTS jobs_expiry ON jobs (expires_at);
+"""
+
+# ---------------- WEBHOOKS ---------------- #
+def validate_webhook_url(url: str) -> str:
+    """
+    Reject webhook URLs that would make the server call into its own network:
+    only http(s), and every address the host resolves to must be public.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("webhook_url must be an http(s) URL")
+    host = parts.hostname.lower()
+    if WEBHOOK_ALLOWED_HOSTS and host not in WEBHOOK_ALLOWED_HOSTS:
+        raise ValueError(f"webhook host {host} is not allowed")
+    try:
+        infos = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == "https" else 80), proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"webhook host {host} does not resolve: {e}")
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast or ip.is_unspecified:
+            raise ValueError(f"webhook host {host} resolves to a non-public address")
+    return url
+
+# ---------------- QUEUE ---------------- #
+class JobQueue:
+    """
+    Durable job queue in a local SQLite file, shared by the API process and the workers.
+
+    A claimed job holds a lease (`locked_until`); if its worker dies or the server
+    restarts mid-run, the lease expires and another worker picks the job up again.
+    Finished jobs keep their result for `result_ttl` seconds.
+    """
+
+    def __init__(self, path: str = "jobs.db", lease: float = 600.0, result_ttl: float = 86400.0,
+                 retry_backoff: float = 5.0):
+        self.path = path
+        self.lease = lease
+        self.result_ttl = result_ttl
+        self.retry_backoff = retry_backoff
+        # Payloads carry at_tokens: create the file owner-only (SQLite gives -wal/-shm the same mode)
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # Autocommit connection per call: cheap for SQLite and safe across threads and processes
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], priority: int = 0, max_attempts: int = 3,
+                webhook_url: Optional[str] = None) -> str:
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if webhook_url: validate_webhook_url(webhook_url)
+        job_id, now = uuid.uuid4().hex, time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO jobs (id, kind, payload, priority, max_attempts, webhook_url, created_at, updated_at, available_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), priority, max(1, max_attempts), webhook_url, now, now, now))
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._public(row) if row else None
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job that has not started yet."""
+        now = time.time()
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE jobs SET status = 'cancelled', updated_at = ?, expires_at = ? WHERE id = ? AND status = 'queued'",
+                (now, now + self.result_ttl, job_id))
+        return cur.rowcount > 0
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically take the highest-priority ready job (or one whose lease expired)."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # An expired lease on the last attempt is left for reap_lost(), not retried
+                row = db.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' AND available_at <= ?) "
+                    "OR (status = 'running' AND locked_until < ? AND attempts < max_attempts) "
+                    "ORDER BY priority DESC, created_at LIMIT 1", (now, now)).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ? WHERE id = ?",
+                        (now + self.lease, now, row["id"]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        if row is None: return None
+        job = dict(row)
+        job["attempts"] += 1
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def complete(self, job: Dict[str, Any], result: Dict[str, Any]):
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = 'succeeded', result = ?, error = NULL, locked_until = NULL, updated_at = ?, expires_at = ? WHERE id = ?",
+                (json.dumps(result), now, now + self.result_ttl, job["id"]))
+
+    def fail(self, job: Dict[str, Any], error: str, result: Optional[Dict[str, Any]] = None) -> bool:
+        """Record a failed attempt; requeues with exponential backoff. Returns True if the job is final."""
+        now = time.time()
+        final = job["attempts"] >= job["max_attempts"]
+        with self._connect() as db:
+            if final:
+                db.execute(
+                    "UPDATE jobs SET status = 'failed', result = ?, error = ?, locked_until = NULL, updated_at = ?, expires_at = ? WHERE id = ?",
+                    (json.dumps(result) if result else None, error, now, now + self.result_ttl, job["id"]))
+            else:
+                delay = self.retry_backoff * 2 ** (job["attempts"] - 1)
+                db.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, locked_until = NULL, updated_at = ?, available_at = ? WHERE id = ?",
+                    (error, now, now + delay, job["id"]))
+        return final
+
+    def reap_lost(self) -> List[Dict[str, Any]]:
+        """
+        Fail jobs whose worker died (lease expired) on their last attempt, so a job that
+        crashes its worker is not retried forever. Returns the jobs failed here.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT * FROM jobs WHERE status = 'running' AND locked_until < ? AND attempts >= max_attempts",
+                    (now,)).fetchall()
+                for row in rows:
+                    db.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, locked_until = NULL, updated_at = ?, expires_at = ? WHERE id = ?",
+                        ("Worker lost during final attempt (lease expired)", now, now + self.result_ttl, row["id"]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in rows]
+
+    def purge_expired(self) -> int:
+        with self._connect() as db:
+            cur = db.execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        return cur.rowcount
+
+    def counts(self) -> Dict[str, int]:
+        with self._connect() as db:
+            return {r["status"]: r["n"] for r in db.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+    @staticmethod
+    def _public(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "priority": row["priority"],
+            "attempts": row["attempts"],
+            "max_attempts": row["max_attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "expires_at": row["expires_at"],
+        }
+
+# ---------------- WORKERS ---------------- #
+def _send_webhook(url: str, body: Dict[str, Any], attempts: int = 3):
+    for i in range(attempts):
+        try:
+            # Re-checked on every attempt: the host may resolve differently than at enqueue time
+            validate_webhook_url(url)
+        except ValueError as e:
+            logger.warning(f"Webhook {url} refused: {e}")
+            return
+        try:
+            r = requests.post(url, json=body, timeout=10, allow_redirects=False)
+            if r.status_code < 500: return
+            logger.warning(f"Webhook {url} returned HTTP {r.status_code}")
+        except requests.RequestException as e:
+            logger.warning(f"Webhook {url} failed: {e}")
+        time.sleep(2 ** i)
+
+def _run_job(job: Dict[str, Any], router, timeout: float) -> Dict[str, Any]:
+    from cancellation import CancelToken
+    payload = dict(job["payload"])
+    # Jobs have no client to disconnect, but still get a deadline that aborts upstream work
+    payload["cancel"] = CancelToken(timeout)
+    if job["kind"] == "api":
+        return asyncio.run(router.backends["http"](payload))
+    if job["kind"] == "browser":
+        return asyncio.run(router.backends["browser"](payload))
+    candidates = ["http", "browser"] if payload.get("at_token") else ["browser"]
+    return asyncio.run(router.generate(payload, candidates=candidates, want_media=bool(payload.get("want_media"))))
+
+def worker_main(db_path: str, stop_event, poll_interval: float = 1.0, lease: float = 600.0,
+                result_ttl: float = 86400.0):
+    """Worker process loop: claim, run, record, notify."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    from backends import run_http_backend, run_browser_backend, start_pool_from_env
+    from router import AdaptiveRouter
+
+    queue = JobQueue(db_path, lease=lease, result_ttl=result_ttl)
+    pool = None
+    use_pool = os.getenv('JOB_WORKER_BROWSER_POOL', 'false').lower() == 'true'
+    router = AdaptiveRouter({"http": run_http_backend, "browser": run_browser_backend})
+    name = multiprocessing.current_process().name
+    last_purge = 0.0
+    logger.info(f"Job worker {name} started")
+    try:
+        while not stop_event.is_set():
+            if time.time() - last_purge > 60:
+                for lost in queue.reap_lost():
+                    logger.warning(f"Job {lost['id']} failed: worker lost on attempt {lost['attempts']}")
+                    if lost["webhook_url"]: _send_webhook(lost["webhook_url"], queue.get(lost["id"]))
+                purged = queue.purge_expired()
+                if purged: logger.info(f"Purged {purged} expired jobs")
+                last_purge = time.time()
+
+            job = queue.claim()
+            if job is None:
+                stop_event.wait(poll_interval)
+                continue
+
+            # Off by default: a pool per worker would mean one more Firefox per process on top of
+            # the API's; browser jobs then launch a short-lived browser per job instead
+            if use_pool and pool is None and job["kind"] in ("browser", "generate"):
+                pool = start_pool_from_env()
+
+            logger.info(f"Worker {name} running job {job['id']} ({job['kind']}, attempt {job['attempts']})")
+            try:
+                result = _run_job(job, router, timeout=min(lease, 300.0))
+            except Exception as e:
+                logger.error(f"Job {job['id']} raised: {e}", exc_info=True)
+                result = {"status": "error", "errors": [str(e)]}
+
+            if result.get("status") == "success":
+                queue.complete(job, result)
+                final = True
+            else:
+                final = queue.fail(job, "; ".join(result.get("errors") or ["unknown error"]), result)
+
+            if final and job.get("webhook_url"):
+                _send_webhook(job["webhook_url"], queue.get(job["id"]))
+    finally:
+        if pool: pool.stop_background()
+        logger.info(f"Job worker {name} stopped")
+
+class WorkerPool:
+    """A fixed set of worker processes consuming one JobQueue."""
+
+    def __init__(self, db_path: str, workers: int = 2, poll_interval: float = 1.0,
+                 lease: float = 600.0, result_ttl: float = 86400.0):
+        self.db_path = db_path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.result_ttl = result_ttl
+        # spawn: the API process runs threads (uvicorn, browser pool) that must not be forked
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stop = self._ctx.Event()
+        self._procs: List[multiprocessing.Process] = []
+
+    def start(self):
+        for i in range(self.workers):
+            p = self._ctx.Process(
+                target=worker_main, name=f"job-worker-{i}", daemon=True,
+                args=(self.db_path, self._stop, self.poll_interval, self.lease, self.result_ttl))
+            p.start()
+            self._procs.append(p)
+        logger.info(f"Started {self.workers} job workers on {self.db_path}")
+
+    def stop(self, timeout: float = 30.0):
+        self._stop.set()
+        deadline = time.time() + timeout
+        for p in self._procs:
+            p.join(max(0.0, deadline - time.time()))
+            if p.is_alive():
+                logger.warning(f"{p.name} did not stop in time; terminating")
+                p.terminate()
+        self._procs = []
@@ -3,10 +3,16 @@ from pathlib import Path
 from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv
 from cookie_helpers import parse_cookies
+from ratelimit import upstream_pacer, account_id, UpstreamBusy
+from cancellation import bounded_timeout
+from media import media_filename
 load_dotenv()
 
 DEFAULT_URL = "https://gemini.google.com/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate"
 
+# Shared session: keeps DNS/TLS to gemini.google.com warm across requests
+_session = requests.Session()
+
 # ---------------- COOKIES ---------------- #
 def load_cookies():
     cookies = parse_cookies()
@@ -41,17 +47,103 @@ def _extract_media(buf:str)->List[str]:
 
 def download_media(url,out="./output"): 
     Path(out).mkdir(exist_ok=True)
-    fn=Path(out)/f"gemini_{int(time.time())}{Path(url).suffix or '.jpg'}"
     try: 
         r=requests.get(url,stream=True,timeout=15)
         r.raise_for_status()
+        fn=Path(out)/media_filename(r.content,"gemini")
         open(fn,"wb").write(r.content)
         return str(fn)
     except: 
         return None
 
+def warm_connection(timeout: float = 10) -> int:
+    """Open a pooled TLS connection to gemini.google.com ahead of the first request."""
+    r = _session.get("https://gemini.google.com/", timeout=timeout, headers={"User-Agent": build_headers(None)["User-Agent"]})
+    return r.status_code
+
+# ---------------- PARSER ---------------- #
+def parse_stream_response(buf:str)->str:
+    """Extract Gemini's answer text from a raw StreamGenerate body."""
+    response_text = ""
+
+    # Method 1: Look for lines starting with )]}'
+    lines = buf.strip().split('\n')
+    for line in lines:
+        if line.startswith(')]}\'\n') or line.startswith(')]}\'\r\n'):
+            line = line[5:]  # Remove the prefix
+        elif line.startswith(')]}\''): 
+            line = line[4:]  # Remove the prefix
+
+        # Skip non-JSON lines
+        if not line.strip() or not line.startswith('['):
+            continue
+
+        try:
+            # Parse the JSON line
+            response_data = json.loads(line)
+
+            # Look for the specific structure: [["wrb.fr", null, "..."]]
+            if (isinstance(response_data, list) and len(response_data) > 0 and 
+                isinstance(response_data[0], list) and len(response_data[0]) > 2 and
+                response_data[0][0] == "wrb.fr"):
+
+                # The third element contains the nested JSON string
+                nested_json_str = response_data[0][2]
+                if isinstance(nested_json_str, str):
+                    try:
+                        # Parse the nested JSON
+                        nested_data = json.loads(nested_json_str)
+
+                        # Navigate to response: nested_data[4][0][1][0]
+                        if (isinstance(nested_data, list) and len(nested_data) > 4 and
+                            isinstance(nested_data[4], list) and len(nested_data[4]) > 0 and
+                            isinstance(nested_data[4][0], list) and len(nested_data[4][0]) > 1 and
+                            isinstance(nested_data[4][0][1], list) and len(nested_data[4][0][1]) > 0):
+
+                            text = nested_data[4][0][1][0]
+                            if isinstance(text, str) and len(text.strip()) > len(response_text.strip()):
+                                response_text = text.strip()
+
+                    except json.JSONDecodeError:
+                        continue
+
+        except json.JSONDecodeError:
+            continue
+
+    # Method 2: Fallback regex if structured parsing fails
+    if not response_text:
+        # Look for quoted strings that look like responses
+        text_patterns = [
+            r'"(I\'m [^"]{50,})"',  # Starts with "I'm" 
+            r'"([^"]{100,})"',     # Long quoted strings
+            r'\[\"([^\"]{50,})\"\]',  # Text in array format
+        ]
+
+        all_matches = []
+        for pattern in text_patterns:
+            matches = re.findall(pattern, buf)
+            all_matches.extend(matches)
+
+        # Filter for conversational text
+        for match in all_matches:
+            # Skip technical strings
+            if any(skip in match.lower() for skip in ['http', 'www.', 'data=', 'wrb.fr', 'maps.google']):
+                continue
+            # Look for response-like content
+            if any(word in match.lower() for word in ['gemini', 'language model', 'help', 'conversation', 'i am', "i'm"]):
+                if len(match) > len(response_text):
+                    response_text = match
+
+    # Clean up response - handle escaped characters
+    if response_text:
+        response_text = response_text.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"')
+    
+    return response_text
+
 # ---------------- CORE ---------------- #
 def run_main(args:Dict[str,Any])->Dict[str,Any]:
+    # Optional CancelToken from the caller: a disconnect or deadline aborts the upstream stream
+    cancel = args.get("cancel")
     try:
         if not args.get("at_token"): 
             return {"status":"error","errors":["Missing at_token"]}
@@ -87,92 +179,35 @@ def run_main(args:Dict[str,Any])->Dict[str,Any]:
             "f.sid": _random_fsid()
         }
         
+        # Smooth calls into StreamGenerate per cookie set, round-robin across clients
+        # (async callers queue before handing off to a thread and set "paced")
+        if not args.get("paced"):
+            try:
+                upstream_pacer.acquire(account_id(), args.get("client") or "default", cancel=cancel)
+            except UpstreamBusy as e:
+                return {"status":"error","errors":[str(e)],"upstream_busy":True}
+        
         buf = ""
-        with requests.post(DEFAULT_URL, headers=headers, params=params, data=data, timeout=60, stream=True) as r:
+        with _session.post(DEFAULT_URL, headers=headers, params=params, data=data, timeout=bounded_timeout(cancel, 60), stream=True) as r:
             if r.status_code != 200: 
                 return {"status":"error","errors":[f"HTTP {r.status_code}"]}
             
-            with open("stream_full.log", "w", encoding="utf-8") as f:
-                for ln in r.iter_lines(decode_unicode=True): 
-                    if not ln: continue
-                    f.write(ln + "\n")
-                    buf += ln + "\n"
-        
-        # Extract response text using improved logic
-        response_text = ""
-        
-        # Method 1: Look for lines starting with )]}'
-        lines = buf.strip().split('\n')
-        for line in lines:
-            if line.startswith(')]}\'\n') or line.startswith(')]}\'\r\n'):
-                line = line[5:]  # Remove the prefix
-            elif line.startswith(')]}\''): 
-                line = line[4:]  # Remove the prefix
-            
-            # Skip non-JSON lines
-            if not line.strip() or not line.startswith('['):
-                continue
-                
+            # Closing the response from the cancelling thread unblocks a stalled read
+            if cancel: cancel.on_cancel(r.close)
             try:
-                # Parse the JSON line
-                response_data = json.loads(line)
-                
-                # Look for the specific structure: [["wrb.fr", null, "..."]]
-                if (isinstance(response_data, list) and len(response_data) > 0 and 
-                    isinstance(response_data[0], list) and len(response_data[0]) > 2 and
-                    response_data[0][0] == "wrb.fr"):
-                    
-                    # The third element contains the nested JSON string
-                    nested_json_str = response_data[0][2]
-                    if isinstance(nested_json_str, str):
-                        try:
-                            # Parse the nested JSON
-                            nested_data = json.loads(nested_json_str)
-                            
-                            # Navigate to response: nested_data[4][0][1][0]
-                            if (isinstance(nested_data, list) and len(nested_data) > 4 and
-                                isinstance(nested_data[4], list) and len(nested_data[4]) > 0 and
-                                isinstance(nested_data[4][0], list) and len(nested_data[4][0]) > 1 and
-                                isinstance(nested_data[4][0][1], list) and len(nested_data[4][0][1]) > 0):
-                                
-                                text = nested_data[4][0][1][0]
-                                if isinstance(text, str) and len(text.strip()) > len(response_text.strip()):
-                                    response_text = text.strip()
-                                    
-                        except json.JSONDecodeError:
-                            continue
-                            
-            except json.JSONDecodeError:
-                continue
+                with open("stream_full.log", "w", encoding="utf-8") as f:
+                    for ln in r.iter_lines(decode_unicode=True): 
+                        if cancel and cancel.cancelled: break
+                        if not ln: continue
+                        f.write(ln + "\n")
+                        buf += ln + "\n"
+            except Exception:
+                if not (cancel and cancel.cancelled): raise
+            if cancel and cancel.cancelled:
+                return {"status":"error","errors":[f"Cancelled: {cancel.reason}"]}
         
-        # Method 2: Fallback regex if structured parsing fails
-        if not response_text:
-            # Look for quoted strings that look like responses
-            text_patterns = [
-                r'"(I\'m [^"]{50,})"',  # Starts with "I'm" 
-                r'"([^"]{100,})"',     # Long quoted strings
-                r'\[\"([^\"]{50,})\"\]',  # Text in array format
-            ]
-            
-            all_matches = []
-            for pattern in text_patterns:
-                matches = re.findall(pattern, buf)
-                all_matches.extend(matches)
-            
-            # Filter for conversational text
-            for match in all_matches:
-                # Skip technical strings
-                if any(skip in match.lower() for skip in ['http', 'www.', 'data=', 'wrb.fr', 'maps.google']):
-                    continue
-                # Look for response-like content
-                if any(word in match.lower() for word in ['gemini', 'language model', 'help', 'conversation', 'i am', "i'm"]):
-                    if len(match) > len(response_text):
-                        response_text = match
+        response_text = parse_stream_response(buf)
         
-        # Clean up response - handle escaped characters
-        if response_text:
-            response_text = response_text.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"')
-            
         media = [{"url": u, "local": download_media(u)} for u in _extract_media(buf)]
         return {"status": "success", "data": {"response": response_text, "media": media}}
         
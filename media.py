@@ -0,0 +1,134 @@
+import os, re, hashlib, logging, threading
+from pathlib import Path
+from typing import Dict, Optional
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is only needed for resized/re-encoded variants
+    Image = None
+
+logger = logging.getLogger("gemini-media")
+
+# Output format -> (Pillow encoder, content type)
+VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+MAX_VARIANT_WIDTH = 4096
+
+# ---------------- HELPERS ---------------- #
+def sniff_extension(data: bytes, default: str = ".jpg") -> str:
+    """File extension from the image's magic bytes (Gemini serves PNG/WebP under any URL)."""
+    if data[:3] == b"\xff\xd8\xff": return ".jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n": return ".png"
+    if data[:6] in (b"GIF87a", b"GIF89a"): return ".gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP": return ".webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"): return ".avif"
+    return default
+
+# Names produced by media_filename(); anything else (older timestamp names) may be overwritten in place
+CONTENT_NAME = re.compile(r"^gemini(?:_image)?_[0-9a-f]{20}\.[a-z0-9]+$")
+
+def media_filename(data: bytes, prefix: str = "gemini_image") -> str:
+    """Name derived from the bytes: parallel downloads never collide and a name never changes content."""
+    return f"{prefix}_{hashlib.sha256(data).hexdigest()[:20]}{sniff_extension(data)}"
+
+def is_content_named(name: str) -> bool:
+    return bool(CONTENT_NAME.match(name))
+
+def sniff_content_type(path: Path) -> str:
+    with open(path, "rb") as f:
+        ext = sniff_extension(f.read(16), default="")
+    return {".jpg": "image/jpeg", ".png": "image/png", ".gif": "image/gif",
+            ".webp": "image/webp", ".avif": "image/avif"}.get(ext, "application/octet-stream")
+
+def format_supported(fmt: str) -> bool:
+    if Image is None or fmt not in VARIANT_FORMATS: return False
+    if fmt == "avif": return bool(features.check("avif"))
+    return True
+
+# ---------------- CACHE ---------------- #
+class VariantCache:
+    """
+    Resized / re-encoded copies of files in `source_dir`, built on first request.
+
+    Variants live in `cache_dir`, keyed by source name, source mtime and the
+    requested width/format/quality, so a replaced original never serves a
+    stale variant. Total size is kept under `max_bytes` by evicting the least
+    recently used files (hits bump the file's mtime).
+    """
+
+    def __init__(self, source_dir: str = "output", cache_dir: str = "media_cache",
+                 max_bytes: int = 256 * 1024 * 1024, quality: int = 80):
+        self.source_dir = Path(source_dir)
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def source(self, name: str) -> Optional[Path]:
+        # Single path segment only; never escape source_dir
+        if not name or Path(name).name != name or name.startswith("."): return None
+        path = self.source_dir / name
+        return path if path.is_file() else None
+
+    def key(self, src: Path, width: Optional[int], fmt: str) -> str:
+        st = src.stat()
+        raw = f"{src.name}|{st.st_mtime_ns}|{st.st_size}|{width or 0}|{fmt}|{self.quality}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _lock(self, key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, src: Path, width: Optional[int], fmt: str) -> Path:
+        """Path of the cached variant, transcoding it first if needed. Blocking; run off the event loop."""
+        key = self.key(src, width, fmt)
+        path = self.cache_dir / f"{key}.{fmt}"
+        lock = self._lock(key)
+        with lock:
+            if path.exists():
+                os.utime(path)
+                return path
+            self._transcode(src, path, width, fmt)
+        with self._locks_guard:
+            self._locks.pop(key, None)
+        self._evict()
+        return path
+
+    def _transcode(self, src: Path, dest: Path, width: Optional[int], fmt: str):
+        encoder = VARIANT_FORMATS[fmt][0]
+        with Image.open(src) as im:
+            im = ImageOps.exif_transpose(im)
+            if width and im.width > width:
+                im = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+            if encoder == "JPEG" and im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            elif im.mode not in ("RGB", "RGBA", "L", "LA"):
+                im = im.convert("RGBA" if "A" in im.getbands() or "transparency" in im.info else "RGB")
+            tmp = dest.with_name(f"{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            opts = {"optimize": True} if encoder in ("JPEG", "PNG") else {}
+            if encoder != "PNG": opts["quality"] = self.quality
+            im.save(tmp, encoder, **opts)
+        os.replace(tmp, dest)
+        logger.info(f"Built {fmt} variant of {src.name} (w={width or 'orig'}): {dest.stat().st_size} bytes")
+
+    def _evict(self):
+        entries = []
+        for p in self.cache_dir.iterdir():
+            if p.suffix == ".tmp": continue
+            try:
+                st = p.stat()
+                entries.append((st.st_mtime, st.st_size, p))
+            except FileNotFoundError:
+                pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes: break
+            try: p.unlink()
+            except FileNotFoundError: pass
+            total -= size
@@ -0,0 +1,134 @@
+import os, sys, time, inspect, logging, threading, tracemalloc
+from collections import Counter
+from typing import Dict, Any, List, Tuple, Callable
+
+logger = logging.getLogger("gemini-profiling")
+
+# Nothing here runs until an admin asks for a profile: no hooks, no tracing, no sampler thread while idle.
+_busy = threading.Lock()
+
+class ProfilerBusy(Exception):
+    """Raised when another profile is already running."""
+
+# ---------------- ATTRIBUTION ---------------- #
+def _targets() -> Dict[str, List[Callable]]:
+    import main, cookie_helpers, headless, browser_pool
+    return {
+        "run_main": [main.run_main],
+        "parser": [main.parse_stream_response],
+        "parse_cookies": [cookie_helpers.parse_cookies],
+        "playwright_flow": [headless.run_headless, headless._chat_on_page, browser_pool.BrowserPool],
+    }
+
+def _spans() -> Dict[str, List[Tuple[str, int, int]]]:
+    """Category -> (filename, first line, last line) of its functions, nested closures included."""
+    spans: Dict[str, List[Tuple[str, int, int]]] = {}
+    for name, objs in _targets().items():
+        for obj in objs:
+            try:
+                lines, first = inspect.getsourcelines(obj)
+                spans.setdefault(name, []).append((os.path.abspath(inspect.getsourcefile(obj)), first, first + len(lines) - 1))
+            except (OSError, TypeError):
+                continue
+    return spans
+
+def _categories(frames: List[Tuple[str, int]], spans) -> List[str]:
+    return [name for name, ranges in spans.items()
+            if any(f == fn and lo <= ln <= hi for f, ln in frames for fn, lo, hi in ranges)]
+
+# ---------------- CPU ---------------- #
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def profile_cpu(seconds: float, interval: float = 0.005) -> Dict[str, Any]:
+    """
+    Sample every thread's stack for `seconds` and return folded stacks
+    (flamegraph.pl / speedscope "collapsed" format) plus per-category shares.
+    Blocking; run it off the event loop.
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        spans = _spans()
+        me = threading.get_ident()
+        names = {}
+        stacks: Counter = Counter()
+        per_category: Counter = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names.update({t.ident: t.name for t in threading.enumerate()})
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                labels, frames = [], []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frames.append((os.path.abspath(frame.f_code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                labels.append(names.get(ident, f"thread-{ident}"))
+                stacks[";".join(reversed(labels))] += 1
+                for cat in _categories(frames, spans):
+                    per_category[cat] += 1
+                samples += 1
+            time.sleep(interval)
+    finally:
+        _busy.release()
+
+    return {
+        "seconds": seconds,
+        "interval": interval,
+        "samples": samples,
+        "attribution": {cat: {"samples": per_category[cat], "share": round(per_category[cat] / samples, 4) if samples else 0.0}
+                        for cat in spans},
+        "collapsed": "\n".join(f"{stack} {n}" for stack, n in stacks.most_common()),
+    }
+
+# ---------------- MEMORY ---------------- #
+def profile_memory(seconds: float, limit: int = 25, frames: int = 25) -> Dict[str, Any]:
+    """
+    Diff two tracemalloc snapshots taken `seconds` apart. Tracing is switched on
+    only for the window (unless it was already on) and off again afterwards.
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    started_here = not tracemalloc.is_tracing()
+    try:
+        if started_here: tracemalloc.start(frames)
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_here: tracemalloc.stop()
+        _busy.release()
+
+    exclude = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    diff = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), "traceback")
+    spans = _spans()
+    per_category: Counter = Counter()
+    folded: Counter = Counter()
+    top = []
+    for stat in diff:
+        if stat.size_diff <= 0: continue
+        tb = [(os.path.abspath(f.filename), f.lineno) for f in stat.traceback]
+        for cat in _categories(tb, spans):
+            per_category[cat] += stat.size_diff
+        # tracemalloc tracebacks run oldest frame first, the same root-first order folded stacks use
+        folded[";".join(f"{os.path.basename(f)}:{ln}" for f, ln in tb)] += stat.size_diff
+        if len(top) < limit:
+            top.append({
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+                "size": stat.size,
+                "traceback": [f"{f.filename}:{f.lineno}" for f in stat.traceback],
+            })
+
+    return {
+        "seconds": seconds,
+        "traced_current": current,
+        "traced_peak": peak,
+        "attribution": {cat: {"size_diff": per_category[cat]} for cat in spans},
+        "top": top,
+        "collapsed": "\n".join(f"{stack} {n}" for stack, n in folded.most_common()),
+    }
@@ -0,0 +1,286 @@
+import os, time, sqlite3, asyncio, hashlib, logging, threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Tuple
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = logging.getLogger("gemini-ratelimit")
+
+class UpstreamBusy(Exception):
+    """Raised when a request waited longer than allowed for an upstream slot."""
+
+# ---------------- BUCKET ---------------- #
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n: float = 1.0) -> Tuple[bool, float]:
+        """Take n tokens if available. Returns (taken, seconds until n tokens are available)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= n:
+                self.tokens -= n
+                return True, 0.0
+            return False, (n - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def state(self) -> Dict[str, float]:
+        with self._lock:
+            self._refill(time.monotonic())
+            full_in = (self.burst - self.tokens) / self.rate if self.rate > 0 else 0.0
+            return {"limit": self.burst, "remaining": self.tokens, "reset": full_in}
+
+class SharedTokenBucket:
+    """
+    TokenBucket whose state is a row in a SQLite file, so every process on the
+    host (API and job workers) draws from one budget. Uses wall-clock time.
+    """
+
+    def __init__(self, path: str, key: str, rate: float, burst: float):
+        self.path = path
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS upstream_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def _update(self, n: float) -> Tuple[bool, float, float]:
+        """Refill and, if n > 0 and enough is there, take n tokens, in one transaction. Returns (taken, tokens, wait)."""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = db.execute("SELECT tokens, updated FROM upstream_buckets WHERE key = ?", (self.key,)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+                taken = n > 0 and tokens >= n
+                if taken: tokens -= n
+                db.execute("INSERT OR REPLACE INTO upstream_buckets (key, tokens, updated) VALUES (?, ?, ?)", (self.key, tokens, now))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+        finally:
+            db.close()
+        if taken or n <= 0: return taken, tokens, 0.0
+        return False, tokens, (n - tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def try_take(self, n: float = 1.0) -> Tuple[bool, float]:
+        taken, _, wait = self._update(n)
+        return taken, wait
+
+    def state(self) -> Dict[str, float]:
+        _, tokens, _ = self._update(0.0)
+        full_in = (self.burst - tokens) / self.rate if self.rate > 0 else 0.0
+        return {"limit": self.burst, "remaining": tokens, "reset": full_in}
+
+# ---------------- CLIENTS ---------------- #
+class ClientLimiter:
+    """Per-client (API key or IP) token buckets; idle buckets beyond `max_clients` are evicted LRU."""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def check(self, key: str) -> Tuple[bool, Dict[str, Any]]:
+        """Consume one request for `key`. Returns (allowed, headers describing the remaining budget)."""
+        bucket = self._bucket(key)
+        allowed, retry_after = bucket.try_take()
+        st = bucket.state()
+        headers = {
+            "X-RateLimit-Limit": str(int(st["limit"])),
+            "X-RateLimit-Remaining": str(int(st["remaining"])),
+            "X-RateLimit-Reset": str(int(st["reset"] + 0.999)),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(int(retry_after + 0.999))
+        return allowed, headers
+
+# ---------------- UPSTREAM ---------------- #
+class _Lane:
+    """Upstream bucket for one cookie set plus its per-client waiting queues."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+
+    def head(self):
+        for q in self.queues.values():
+            return q[0]
+        return None
+
+    def pop_head(self):
+        client, q = next(iter(self.queues.items()))
+        q.popleft()
+        # Round-robin: the client just served goes to the back of the line
+        if q: self.queues.move_to_end(client)
+        else: del self.queues[client]
+
+    def remove(self, client: str, ticket):
+        q = self.queues.get(client)
+        if q is None: return
+        try: q.remove(ticket)
+        except ValueError: return
+        if not q: del self.queues[client]
+
+class UpstreamPacer:
+    """
+    Smooths calls into Gemini per cookie set instead of letting them burst.
+
+    Each cookie set has its own token bucket. Waiters are queued per client and
+    served round-robin, so one client submitting many requests cannot starve the
+    others sharing the same Google session.
+
+    With `db_path` the buckets live in that SQLite file and are shared by every
+    process using it (the API and its job workers); the round-robin queue is
+    still per process. Without it, the bucket is in memory.
+    """
+
+    def __init__(self, rate: float, burst: float, max_wait: Optional[float] = None, db_path: Optional[str] = None):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.db_path = db_path
+        self._lanes: Dict[str, _Lane] = {}
+        self._cond = threading.Condition()
+
+    def _join(self, account: str, client: str):
+        """Queue a ticket for `client` on `account`'s lane. Call with the lock held."""
+        lane = self._lanes.get(account)
+        if lane is None:
+            bucket = SharedTokenBucket(self.db_path, account, self.rate, self.burst) if self.db_path \
+                else TokenBucket(self.rate, self.burst)
+            lane = self._lanes[account] = _Lane(bucket)
+        ticket = object()
+        lane.queues.setdefault(client, deque()).append(ticket)
+        return lane, ticket
+
+    def _leave(self, lane: _Lane, client: str, ticket):
+        with self._cond:
+            lane.remove(client, ticket)
+            self._cond.notify_all()
+
+    def _poll(self, lane: _Lane, client: str, ticket, started: float, timeout: Optional[float],
+              cancel) -> Tuple[Optional[float], Optional[float]]:
+        """
+        One look at the line, with the lock held. Returns (seconds waited, None) once the
+        ticket is served, else (None, seconds to sleep or None for "until woken").
+        Gives up the place in line and raises UpstreamBusy on cancel or timeout.
+        """
+        wait = None
+        if cancel is not None and cancel.cancelled:
+            lane.remove(client, ticket)
+            self._cond.notify_all()
+            raise UpstreamBusy(f"Cancelled while waiting for upstream: {cancel.reason}")
+        if lane.head() is ticket:
+            taken, wait = lane.bucket.try_take()
+            if taken:
+                lane.pop_head()
+                self._cond.notify_all()
+                waited = time.monotonic() - started
+                if waited > 0.05: logger.info(f"Paced upstream call for client {client}: waited {waited:.2f}s")
+                return waited, None
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - started)
+            if remaining <= 0:
+                lane.remove(client, ticket)
+                self._cond.notify_all()
+                raise UpstreamBusy(f"Upstream busy: no slot within {timeout:g}s")
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _timeout(self, timeout: Optional[float], cancel) -> Optional[float]:
+        timeout = self.max_wait if timeout is None else timeout
+        if cancel is not None and cancel.remaining() is not None:
+            timeout = cancel.remaining() if timeout is None else min(timeout, cancel.remaining())
+        return timeout
+
+    def acquire(self, account: str, client: str = "default", timeout: Optional[float] = None, cancel=None) -> float:
+        """
+        Block until `client` may call upstream with `account`. Returns the seconds waited.
+        `cancel` is an optional CancelToken; cancelling it (or its deadline) gives up the place in line.
+        """
+        if cancel is not None: cancel.on_cancel(self._wake)
+        timeout = self._timeout(timeout, cancel)
+        started = time.monotonic()
+        with self._cond:
+            lane, ticket = self._join(account, client)
+            while True:
+                waited, wait = self._poll(lane, client, ticket, started, timeout, cancel)
+                if waited is not None: return waited
+                self._cond.wait(wait)
+
+    async def acquire_async(self, account: str, client: str = "default", timeout: Optional[float] = None,
+                            cancel=None, poll_interval: float = 0.05) -> float:
+        """
+        acquire() for event loops: waits with asyncio.sleep instead of holding a thread,
+        in the same line as threaded callers. Cancelling the task gives up the place in line.
+        """
+        timeout = self._timeout(timeout, cancel)
+        started = time.monotonic()
+        with self._cond:
+            lane, ticket = self._join(account, client)
+        try:
+            while True:
+                with self._cond:
+                    waited, wait = self._poll(lane, client, ticket, started, timeout, cancel)
+                if waited is not None: return waited
+                # Polled: threaded waiters are woken by the condition, coroutines cannot be
+                await asyncio.sleep(poll_interval if wait is None else min(wait, poll_interval))
+        except asyncio.CancelledError:
+            self._leave(lane, client, ticket)
+            raise
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def pending(self, account: str) -> int:
+        with self._cond:
+            lane = self._lanes.get(account)
+            return sum(len(q) for q in lane.queues.values()) if lane else 0
+
+def account_id(cookies: Optional[str] = None, cookies_file: Optional[str] = None) -> str:
+    """Opaque pacing key for a cookie source (defaults to the GEMINI_COOKIES* env), never the secret itself."""
+    if not cookies and not cookies_file:
+        cookies, cookies_file = os.getenv('GEMINI_COOKIES'), os.getenv('GEMINI_COOKIES_FILE')
+    return hashlib.sha1(f"{cookies or ''}|{cookies_file or ''}".encode()).hexdigest()[:16]
+
+# Upstream pacer; its buckets sit next to the job queue so the API and the job workers share one budget
+upstream_pacer = UpstreamPacer(
+    rate=float(os.getenv('UPSTREAM_RATE', '0.5')),
+    burst=float(os.getenv('UPSTREAM_BURST', '3')),
+    max_wait=float(os.getenv('UPSTREAM_MAX_WAIT', '60')),
+    db_path=os.getenv('UPSTREAM_DB') or os.getenv('JOBS_DB') or 'jobs.db',
+)
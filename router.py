@@ -0,0 +1,150 @@
+import random, time, threading, logging
+from collections import deque
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+logger = logging.getLogger("gemini-router")
+
+# Relative resource cost of a backend call per second of latency (browser ~10x the HTTP path)
+DEFAULT_COSTS = {"http": 1.0, "browser": 10.0}
+# Latency priors (seconds) used until a backend has recorded samples
+DEFAULT_LATENCY = {"http": 5.0, "browser": 40.0}
+
+# ---------------- STATS ---------------- #
+class BackendStats:
+    """Rolling window of outcomes for one backend: success, latency and media delivery."""
+
+    def __init__(self, window: int = 50, latency_prior: float = 10.0):
+        self._samples = deque(maxlen=window)   # (ok, latency)
+        self._media = deque(maxlen=window)     # media delivered when it was asked for
+        self._latency_prior = latency_prior
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool, latency: float, media: Optional[bool] = None):
+        with self._lock:
+            self._samples.append((ok, latency))
+            if media is not None: self._media.append(media)
+
+    @property
+    def samples(self) -> int:
+        return len(self._samples)
+
+    @property
+    def success_rate(self) -> float:
+        # Laplace-smoothed so an empty or tiny window is neither trusted nor condemned
+        with self._lock:
+            ok = sum(1 for s, _ in self._samples if s)
+            return (ok + 1) / (len(self._samples) + 2)
+
+    @property
+    def media_rate(self) -> float:
+        with self._lock:
+            return (sum(self._media) + 1) / (len(self._media) + 2)
+
+    @property
+    def latency(self) -> float:
+        """Median latency of successful calls, or the prior when there are none."""
+        with self._lock:
+            lat = sorted(l for s, l in self._samples if s)
+        return lat[len(lat) // 2] if lat else self._latency_prior
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "samples": self.samples,
+            "success_rate": round(self.success_rate, 3),
+            "media_rate": round(self.media_rate, 3),
+            "latency_p50": round(self.latency, 3),
+        }
+
+# ---------------- ROUTER ---------------- #
+class AdaptiveRouter:
+    """
+    Orders backends per request by expected cost and falls back down the list.
+
+    The expected cost of trying A before B is cost(A) + (1 - p(A)) * cost(B), where
+    cost is latency weighted by the backend's resource cost and p is its rolling
+    success rate (or media delivery rate when the caller wants media). A small
+    exploration rate keeps the non-preferred order sampled so a recovered
+    backend wins its traffic back.
+    """
+
+    def __init__(self, backends: Dict[str, Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]],
+                 window: int = 50, explore: float = 0.05, costs: Optional[Dict[str, float]] = None):
+        self.backends = backends
+        self.costs = {**DEFAULT_COSTS, **(costs or {})}
+        self.explore = explore
+        self.stats = {name: BackendStats(window, DEFAULT_LATENCY.get(name, 10.0)) for name in backends}
+
+    def _p(self, name: str, want_media: bool) -> float:
+        st = self.stats[name]
+        return st.success_rate * (st.media_rate if want_media else 1.0)
+
+    def _cost(self, name: str) -> float:
+        return self.stats[name].latency * self.costs.get(name, 1.0)
+
+    def plan(self, candidates: List[str], want_media: bool = False) -> List[str]:
+        if len(candidates) < 2: return list(candidates)
+        a, b = candidates[0], candidates[1]
+        a_first = self._cost(a) + (1 - self._p(a, want_media)) * self._cost(b)
+        b_first = self._cost(b) + (1 - self._p(b, want_media)) * self._cost(a)
+        order = [a, b] if a_first <= b_first else [b, a]
+        if random.random() < self.explore: order.reverse()
+        return order + list(candidates[2:])
+
+    @staticmethod
+    def _usable(result: Dict[str, Any], want_media: bool) -> bool:
+        if not isinstance(result, dict) or result.get("status") != "success": return False
+        data = result.get("data") or {}
+        if not (data.get("response") or "").strip(): return False
+        return bool(data.get("media")) if want_media else True
+
+    async def generate(self, args: Dict[str, Any], candidates: Optional[List[str]] = None,
+                       want_media: bool = False) -> Dict[str, Any]:
+        order = self.plan(candidates or list(self.backends), want_media)
+        result: Dict[str, Any] = {"status": "error", "errors": ["No backend available"]}
+        errors: List[str] = []
+        text_only: Optional[Dict[str, Any]] = None
+        cancel = args.get("cancel")
+        for i, name in enumerate(order):
+            # A disconnected client or spent deadline is not a reason to try the next backend
+            if cancel is not None and cancel.cancelled:
+                errors.append(f"{name}: skipped ({cancel.reason})")
+                break
+            started = time.monotonic()
+            try:
+                result = await self.backends[name](dict(args))
+            except Exception as e:
+                logger.warning(f"Backend {name} raised: {e}")
+                result = {"status": "error", "errors": [str(e)]}
+            latency = time.monotonic() - started
+            if cancel is not None and cancel.cancelled:
+                # Aborted attempts say nothing about backend health
+                errors.append(f"{name}: {cancel.reason}")
+                break
+            if result.get("upstream_busy"):
+                # Pacing rejection, not a backend failure; every backend waits in the same per-account line
+                if errors: result["fallback_errors"] = errors
+                return result
+            ok = self._usable(result, False)
+            media = bool((result.get("data") or {}).get("media")) if ok and want_media else None
+            self.stats[name].record(ok, latency, media)
+
+            if self._usable(result, want_media):
+                result["backend"] = name
+                if errors: result["fallback_errors"] = errors
+                return result
+            if ok and text_only is None:
+                text_only = {**result, "backend": name}
+            reason = "; ".join(result.get("errors") or []) if result.get("status") != "success" else \
+                "empty response" if not ok else "no media"
+            errors.append(f"{name}: {reason}")
+            if i + 1 < len(order):
+                logger.info(f"Backend {name} unusable ({reason}), falling back to {order[i + 1]}")
+
+        # Every backend missed; a text-only success still beats an error when media was wanted
+        if text_only is not None:
+            text_only["fallback_errors"] = errors
+            return text_only
+        return {"status": "error", "errors": errors or result.get("errors", [])}
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: st.snapshot() for name, st in self.stats.items()}
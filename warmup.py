@@ -0,0 +1,139 @@
+import asyncio, os, socket, time, logging
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+logger = logging.getLogger("gemini-warmup")
+
+GEMINI_HOST = "gemini.google.com"
+# Cookies without which Gemini treats the session as signed out
+SESSION_COOKIES = ("__Secure-1PSID", "__Secure-3PSID", "SID")
+DEFAULT_STEPS = ("cookies", "dns", "tls", "browser", "page")
+# Steps that need another step to have passed first; every other step starts right away
+DEPENDS = {"page": ("browser",)}
+
+# ---------------- STEPS ---------------- #
+async def warm_cookies(ctx: Dict[str, Any]) -> str:
+    from cookie_helpers import parse_cookies
+    cookies = await asyncio.to_thread(parse_cookies)
+    if not cookies:
+        raise RuntimeError("No cookies configured")
+    names = {c.get("name") for c in cookies}
+    if not names.intersection(SESSION_COOKIES):
+        raise RuntimeError(f"No session cookie found (expected one of {', '.join(SESSION_COOKIES)})")
+    ctx["cookies"] = cookies
+    return f"{len(cookies)} cookies"
+
+async def warm_dns(ctx: Dict[str, Any]) -> str:
+    infos = await asyncio.to_thread(socket.getaddrinfo, GEMINI_HOST, 443, 0, socket.SOCK_STREAM)
+    return f"{len(infos)} addresses"
+
+async def warm_tls(ctx: Dict[str, Any]) -> str:
+    from main import warm_connection
+    return f"HTTP {await asyncio.to_thread(warm_connection)}"
+
+async def warm_browser(ctx: Dict[str, Any]) -> str:
+    from backends import start_pool_from_env
+    from browser_pool import get_pool
+    if get_pool() is None and await asyncio.to_thread(start_pool_from_env) is None:
+        raise RuntimeError("Browser pool failed to start")
+    return "browser pool up"
+
+async def warm_page(ctx: Dict[str, Any]) -> str:
+    from browser_pool import get_pool, account_key
+    pool = get_pool()
+    if pool is None:
+        raise RuntimeError("Browser pool not started")
+    cookies = ctx.get("cookies")
+    if cookies is None:
+        from cookie_helpers import parse_cookies
+        cookies = ctx["cookies"] = await asyncio.to_thread(parse_cookies)
+    # A fresh login check doubles as cookie validation and snapshot capture
+    if cookies and not await pool.run(lambda: pool.refresh_snapshot(account_key(cookies), cookies)):
+        raise RuntimeError("Cookies are not signed in to Gemini")
+    warm = await pool.run(lambda: pool.prefill(cookies))
+    return f"{warm} warm contexts"
+
+STEPS: Dict[str, Callable[[Dict[str, Any]], Awaitable[str]]] = {
+    "cookies": warm_cookies,
+    "dns": warm_dns,
+    "tls": warm_tls,
+    "browser": warm_browser,
+    "page": warm_page,
+}
+
+# ---------------- RUNNER ---------------- #
+class Warmup:
+    """
+    Runs the configured warm-up steps in the background after startup.
+
+    Steps run side by side, so a failing check never holds back the shared
+    browser; only the steps in DEPENDS wait for theirs. A failed step is retried
+    every `retry_interval` seconds. `ready` turns true once every step passed.
+    """
+
+    def __init__(self, steps: Optional[List[str]] = None, retry_interval: float = 30.0, step_timeout: float = 120.0):
+        steps = list(DEFAULT_STEPS if steps is None else steps)
+        unknown = [s for s in steps if s not in STEPS]
+        if unknown:
+            raise ValueError(f"Unknown warm-up steps: {', '.join(unknown)}")
+        self.steps = steps
+        self.retry_interval = retry_interval
+        self.step_timeout = step_timeout
+        self.state: Dict[str, Dict[str, Any]] = {s: {"status": "pending"} for s in steps}
+        self._ctx: Dict[str, Any] = {}
+        self._done: Dict[str, asyncio.Event] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return all(st["status"] == "ok" for st in self.state.values())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+    async def _run(self):
+        started = time.monotonic()
+        self._done = {s: asyncio.Event() for s in self.steps}
+        await asyncio.gather(*(self._run_step(name) for name in self.steps))
+        logger.info(f"Warm-up complete in {time.monotonic() - started:.1f}s; ready for traffic")
+
+    async def _run_step(self, name: str):
+        for dep in DEPENDS.get(name, ()):
+            if dep in self._done: await self._done[dep].wait()
+        st = self.state[name]
+        while True:
+            st["status"] = "running"
+            t0 = time.monotonic()
+            try:
+                st["detail"] = await asyncio.wait_for(STEPS[name](self._ctx), timeout=self.step_timeout)
+                st.update(status="ok", seconds=round(time.monotonic() - t0, 3))
+                st.pop("error", None)
+                logger.info(f"Warm-up step {name} ok in {st['seconds']}s: {st['detail']}")
+                self._done[name].set()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                st.update(status="failed", error=str(e) or type(e).__name__, seconds=round(time.monotonic() - t0, 3))
+                logger.warning(f"Warm-up step {name} failed: {st['error']}; retrying in {self.retry_interval:g}s")
+                await asyncio.sleep(self.retry_interval)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "steps": self.state}
+
+def warmup_from_env() -> Warmup:
+    raw = os.getenv('WARMUP_STEPS')
+    steps = [s.strip() for s in raw.split(",") if s.strip()] if raw is not None else list(DEFAULT_STEPS)
+    if os.getenv('BROWSER_POOL', 'true').lower() != 'true':
+        # No shared browser to start or warm
+        steps = [s for s in steps if s not in ("browser", "page")]
+    elif "browser" not in steps:
+        # The pool is started here, so it cannot be skipped while enabled
+        steps.insert(steps.index("page") if "page" in steps else len(steps), "browser")
+    return Warmup(steps, retry_interval=float(os.getenv('WARMUP_RETRY_INTERVAL', '30')))